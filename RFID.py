@@ -1,5 +1,102 @@
-import RPi.GPIO as GPIO
-import spi as SPI
+import collections
+import time
+
+try:
+    import RPi.GPIO as GPIO
+    import spi as SPI
+except ImportError:
+    # off-device: RFID can only be used with another transport, e.g. spitrace.ReplayTransport
+    GPIO = None
+    SPI = None
+
+
+def make_crc_a_table():
+    """
+    Lookup table for ISO 14443-3 CRC_A (polynomial x^16 + x^12 + x^5 + 1, reflected)
+    """
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            if crc & 0x0001:
+                crc = (crc >> 1) ^ 0x8408
+            else:
+                crc >>= 1
+        table.append(crc)
+    return table
+
+
+CRC_A_TABLE = make_crc_a_table()
+
+
+def crc_a(data):
+    """
+    Calculate ISO 14443-3 CRC_A of data in software.
+    Returns list of two bytes, LSB first, as appended to frames.
+    """
+    crc = 0x6363
+    for byte in data:
+        crc = (crc >> 8) ^ CRC_A_TABLE[(crc ^ byte) & 0xFF]
+    return [crc & 0xFF, crc >> 8]
+
+
+class HardwareTransport(object):
+    """
+    SPI bus and GPIO pins connecting the reader to the RasPi
+    """
+
+    def __init__(self, dev='/dev/spidev0.0', speed=1000000, pin_rst=22, pin_ce=0, pin_irq=None):
+        self.pin_rst = pin_rst
+        self.pin_ce = pin_ce
+        self.pin_irq = pin_irq
+
+        SPI.openSPI(device=dev, speed=speed)
+        GPIO.setmode(GPIO.BOARD)
+        GPIO.setup(pin_rst, GPIO.OUT)
+        GPIO.output(pin_rst, 1)
+        if pin_ce != 0:
+            GPIO.setup(pin_ce, GPIO.OUT)
+            GPIO.output(pin_ce, 1)
+        if pin_irq is not None:
+            GPIO.setup(pin_irq, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+
+    def transfer(self, data):
+        if self.pin_ce != 0:
+            GPIO.output(self.pin_ce, 0)
+        r = SPI.transfer(data)
+        if self.pin_ce != 0:
+            GPIO.output(self.pin_ce, 1)
+        return r
+
+    def wait_irq(self, timeout):
+        """
+        Wait until the reader's IRQ output is active or timeout (seconds) has passed.
+        Returns False if no IRQ pin is connected or the output is active already; the
+        caller has to poll the status register then.
+        """
+        if self.pin_irq is None:
+            return False
+
+        # IRQ output is active low (IRqInv set in ComIEnReg); if it is low already, an interrupt
+        # is pending that did not end the wait (e.g. ErrIRq), so there is no edge to wait for
+        if not GPIO.input(self.pin_irq):
+            return False
+
+        GPIO.wait_for_edge(self.pin_irq, GPIO.FALLING, timeout=max(1, int(timeout * 1000)))
+        return True
+
+    def monotonic(self):
+        """
+        Clock for command deadlines (seconds)
+        """
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def close(self):
+        GPIO.cleanup()
+        SPI.closeSPI()
 
 
 class RFID:
@@ -28,53 +125,165 @@ class RFID:
     act_reqall = 0x52
     act_anticl = 0x93
     act_select = 0x93
+    act_anticl2 = 0x95
+    act_select2 = 0x95
     act_end = 0x50
 
+    # first byte of the cascade level 1 UID of double size UIDs
+    cascade_tag = 0x88
+
     reg_tx_control = 0x14
     length = 16
 
+    # error codes, see last_error
+    err_ok = 0
+    err_timeout = 1  # reader did not finish the command before the deadline
+    err_no_response = 2  # tag did not answer before the RC522 timer ran out
+    err_protocol = 3  # reader signaled an error in ErrorReg
+    err_crc_timeout = 4  # CRC coprocessor did not finish before the deadline
+    err_idle = 5  # no tag answered a request (REQA/WUPA), the normal state without token
+
+    # error codes not counted in error_counts
+    err_not_counted = (err_ok, err_idle)
+
+    err_names = {
+        err_timeout: 'timeout',
+        err_no_response: 'no_response',
+        err_protocol: 'protocol',
+        err_crc_timeout: 'crc_timeout',
+        err_idle: 'idle',
+    }
+
+    # RC522 timer: TAuto, prescaler 0xD3E gives 2 kHz (0.5 ms per tick), reload value 30
+    # ticks - tag did not answer if the timer runs out 15 ms after transmission
+    timer_prescaler = 0xD3E
+    timer_reload = 30
+
+    # interval between status register checks, if no IRQ pin is used (seconds)
+    poll_interval = 0.0005
+
+    # error counts by name, for all instances in this process
+    error_counts = collections.Counter()
+
+    # registers whose content is determined by what the driver writes, kept in a shadow
+    # to avoid reads before writes: address -> mask of bits kept in the shadow (read-only
+    # and self-clearing bits are excluded and read as zero from the shadow)
+    shadow_masks = {
+        0x02: 0xFF,  # ComIEnReg
+        0x08: 0xC8,  # Status2Reg: MFCrypto1On is set by the reader on auth, card_auth reads it back
+        0x0A: 0x00,  # FIFOLevelReg: FlushBuffer clears itself, the level is read-only
+        0x0D: 0xFF,  # BitFramingReg
+        0x11: 0xFF,  # ModeReg
+        0x14: 0xFF,  # TxControlReg
+        0x15: 0xFF,  # TxASKReg
+        0x2A: 0xFF,  # TModeReg
+        0x2B: 0xFF,  # TPrescalerReg
+        0x2C: 0xFF,  # TReloadReg high byte
+        0x2D: 0xFF,  # TReloadReg low byte
+    }
+
+    # content of shadowed registers after soft reset
+    shadow_reset_values = {
+        0x02: 0x80,
+        0x08: 0x00,
+        0x0A: 0x00,
+        0x0D: 0x00,
+        0x11: 0x3F,
+        0x14: 0x80,
+        0x15: 0x00,
+        0x2A: 0x00,
+        0x2B: 0x00,
+        0x2C: 0x00,
+        0x2D: 0x00,
+    }
+
     authed = False
 
-    def __init__(self, dev='/dev/spidev0.0', speed=1000000, pin_rst=22, pin_ce=0):
+    def __init__(self, dev='/dev/spidev0.0', speed=1000000, pin_rst=22, pin_ce=0, pin_irq=None, timeout=0.05,
+                 hw_crc=False, shadow=True, transport=None, recorder=None):
+        """
+        pin_irq -- board pin connected to the reader's IRQ output, None to poll the status register
+        timeout -- deadline for a reader command to finish (seconds), a safety net on top of the RC522 timer
+        hw_crc -- calculate CRCs with the reader's coprocessor instead of in software
+        shadow -- keep configuration registers in a shadow, see shadow_masks
+        transport -- object for SPI transfers and the clock, HardwareTransport on dev and pins if None
+        recorder -- spitrace.SPIRecorder logging all SPI transactions and clock reads, or None
+        """
         self.pin_rst = pin_rst
         self.pin_ce = pin_ce
+        self.pin_irq = pin_irq
+        self.timeout = timeout
+        self.hw_crc = hw_crc
+
+        # known content of shadowed registers (address -> value), None if shadowing is disabled
+        self.shadow = dict() if shadow else None
+
+        # number of SPI transactions, for measuring
+        self.transfer_count = 0
+
+        # error code of the last command
+        self.last_error = self.err_ok
+
+        if transport is None:
+            transport = HardwareTransport(dev, speed, pin_rst, pin_ce, pin_irq)
+        self.transport = transport
+        self.recorder = recorder
 
-        SPI.openSPI(device=dev, speed=speed)
-        GPIO.setmode(GPIO.BOARD)
-        GPIO.setup(pin_rst, GPIO.OUT)
-        GPIO.output(pin_rst, 1)
-        if pin_ce != 0:
-            GPIO.setup(pin_ce, GPIO.OUT)
-            GPIO.output(pin_ce, 1)
         self.reset()
-        self.dev_write(0x2A, 0x8D)
-        self.dev_write(0x2B, 0x3E)
-        self.dev_write(0x2D, 30)
-        self.dev_write(0x2C, 0)
+        self.dev_write(0x2A, 0x80 | (self.timer_prescaler >> 8))
+        self.dev_write(0x2B, self.timer_prescaler & 0xFF)
+        self.dev_write(0x2D, self.timer_reload & 0xFF)
+        self.dev_write(0x2C, self.timer_reload >> 8)
         self.dev_write(0x15, 0x40)
         self.dev_write(0x11, 0x3D)
         self.set_antenna(True)
 
+    def monotonic(self):
+        """
+        Read the transport's clock, recording the value so replays take the same decisions
+        """
+        t = self.transport.monotonic()
+        if self.recorder is not None:
+            self.recorder.record_clock(t)
+        return t
+
     def spi_transfer(self, data):
-        if self.pin_ce != 0:
-            GPIO.output(self.pin_ce, 0)
-        r = SPI.transfer(data)
-        if self.pin_ce != 0:
-            GPIO.output(self.pin_ce, 1)
+        self.transfer_count += 1
+        r = self.transport.transfer(data)
+        if self.recorder is not None:
+            self.recorder.record(data, r)
         return r
 
     def dev_write(self, address, value):
         self.spi_transfer(((address << 1) & 0x7E, value))
+        if self.shadow is not None and address in self.shadow_masks:
+            self.shadow[address] = value & self.shadow_masks[address]
 
     def dev_read(self, address):
+        if self.shadow is not None and address in self.shadow_masks:
+            # fully shadowed registers need no transfer, others refresh their shadow
+            if self.shadow_masks[address] == 0xFF and address in self.shadow:
+                return self.shadow[address]
+            value = self.spi_transfer((((address << 1) & 0x7E) | 0x80, 0))[1]
+            self.shadow[address] = value & self.shadow_masks[address]
+            return value
         return self.spi_transfer((((address << 1) & 0x7E) | 0x80, 0))[1]
 
+    def register_value(self, address):
+        """
+        Get register content for read-modify-write, from the shadow if possible.
+        Read-only and self-clearing bits of shadowed registers are zero, they are ignored on writing.
+        """
+        if self.shadow is not None and address in self.shadow:
+            return self.shadow[address]
+        return self.dev_read(address)
+
     def set_bitmask(self, address, mask):
-        current = self.dev_read(address)
+        current = self.register_value(address)
         self.dev_write(address, current | mask)
 
     def clear_bitmask(self, address, mask):
-        current = self.dev_read(address)
+        current = self.register_value(address)
         self.dev_write(address, current & (~mask))
 
     def set_antenna(self, state):
@@ -85,7 +294,34 @@ class RFID:
         else:
             self.clear_bitmask(self.reg_tx_control, 0x03)
 
-    def card_write(self, command, data):
+    def set_error(self, error):
+        """
+        Record error code of the current command
+        """
+        self.last_error = error
+        if error not in self.err_not_counted:
+            self.error_counts[self.err_names[error]] += 1
+
+    def wait_irq(self, address, mask, deadline):
+        """
+        Wait until one of the bits in mask is set in IRQ register address, or the deadline
+        (monotonic() value) has passed.
+        Returns the register value, or None on timeout.
+        """
+        while True:
+            n = self.dev_read(address)
+            if n & mask:
+                return n
+
+            remaining = deadline - self.monotonic()
+            if remaining <= 0:
+                return None
+
+            # the IRQ output only reflects ComIrqReg
+            if address != 0x04 or not self.transport.wait_irq(remaining):
+                self.transport.sleep(min(self.poll_interval, remaining))
+
+    def card_write(self, command, data, err_no_response=err_no_response):
         back_data = []
         back_length = 0
         error = False
@@ -99,7 +335,9 @@ class RFID:
             irq = 0x77
             irq_wait = 0x30
 
-        self.dev_write(0x02, irq | 0x80)
+        # IRQ output (ComIEnReg, inverted): only the interrupts that end the wait, plus
+        # ErrIRq - TxIRq and LoAlertIRq would assert it right after sending the frame
+        self.dev_write(0x02, (irq & (irq_wait | 0x03)) | 0x80)
         self.clear_bitmask(0x04, 0x80)
         self.set_bitmask(0x0A, 0x80)
         self.dev_write(0x01, self.mode_idle)
@@ -112,42 +350,41 @@ class RFID:
         if command == self.mode_transrec:
             self.set_bitmask(0x0D, 0x80)
 
-        i = 2000
-        while True:
-            n = self.dev_read(0x04)
-            i -= 1
-            if ~((i != 0) and ~(n & 0x01) and ~(n & irq_wait)):
-                break
+        # the RC522 timer signals TimerIRq if the tag does not answer in time
+        n = self.wait_irq(0x04, irq_wait | 0x01, self.monotonic() + self.timeout)
 
         self.clear_bitmask(0x0D, 0x80)
 
-        if i != 0:
-            if (self.dev_read(0x06) & 0x1B) == 0x00:
-                error = False
+        if n is None:
+            self.set_error(self.err_timeout)
+            error = True
+        elif (self.dev_read(0x06) & 0x1B) == 0x00:
+            error = False
+            self.set_error(self.err_ok)
 
-                if n & irq & 0x01:
-                    print('E1')
-                    error = True
+            if n & irq & 0x01:
+                self.set_error(err_no_response)
+                error = True
 
-                if command == self.mode_transrec:
-                    n = self.dev_read(0x0A)
-                    last_bits = self.dev_read(0x0C) & 0x07
-                    if last_bits != 0:
-                        back_length = (n - 1) * 8 + last_bits
-                    else:
-                        back_length = n * 8
+            elif command == self.mode_transrec:
+                n = self.dev_read(0x0A)
+                last_bits = self.dev_read(0x0C) & 0x07
+                if last_bits != 0:
+                    back_length = (n - 1) * 8 + last_bits
+                else:
+                    back_length = n * 8
 
-                    if n == 0:
-                        n = 1
+                if n == 0:
+                    n = 1
 
-                    if n > self.length:
-                        n = self.length
+                if n > self.length:
+                    n = self.length
 
-                    for i in range(n):
-                        back_data.append(self.dev_read(0x09))
-            else:
-                print('E2')
-                error = True
+                for i in range(n):
+                    back_data.append(self.dev_read(0x09))
+        else:
+            self.set_error(self.err_protocol)
+            error = True
 
         return error, back_data, back_length
 
@@ -157,16 +394,19 @@ class RFID:
         Returns (False, None) if no tag is present, otherwise returns (True, tag type)
         """
         self.dev_write(0x0D, 0x07)
-        (error, back_data, back_bits) = self.card_write(self.mode_transrec, [req_mode, ])
+        # no answer just means there is no tag, polling does this all the time
+        (error, back_data, back_bits) = self.card_write(self.mode_transrec, [req_mode, ],
+                                                        err_no_response=self.err_idle)
 
         if error or (back_bits != 0x10):
             return True, None
 
         return False, back_bits
 
-    def anticoll(self):
+    def anticoll(self, cascade_level=act_anticl):
         """
         Anti-collision detection.
+        cascade_level -- act_anticl or act_anticl2
         Returns tuple of (error state, tag ID).
         """
         serial_number = []
@@ -174,7 +414,7 @@ class RFID:
         serial_number_check = 0
 
         self.dev_write(0x0D, 0x00)
-        serial_number.append(self.act_anticl)
+        serial_number.append(cascade_level)
         serial_number.append(0x20)
 
         (error, back_data, back_bits) = self.card_write(self.mode_transrec, serial_number)
@@ -190,7 +430,35 @@ class RFID:
 
         return error, back_data
 
+    def read_uid(self):
+        """
+        Get the complete UID, selecting cascade level 1 for double size (7 byte) UIDs.
+        Returns tuple of (error state, UID without cascade tag and BCC - 4 or 7 bytes).
+        """
+        error, serial_number = self.anticoll()
+        if error or serial_number[0] != self.cascade_tag:
+            return error, serial_number[:4]
+
+        if self.select_tag(serial_number):
+            return True, []
+
+        error, serial_number_cl2 = self.anticoll(self.act_anticl2)
+        return error, serial_number[1:4] + serial_number_cl2[:4]
+
     def calculate_crc(self, data):
+        """
+        Calculate CRC_A of data, in software unless hw_crc is set.
+        Returns list of two bytes.
+        """
+        if self.hw_crc:
+            return self.calculate_crc_hw(data)
+        return crc_a(data)
+
+    def calculate_crc_hw(self, data):
+        """
+        Calculate CRC_A of data with the reader's CRC coprocessor - needs 10+ SPI transactions.
+        Returns list of two bytes.
+        """
         self.clear_bitmask(0x05, 0x04)
         self.set_bitmask(0x0A, 0x80)
 
@@ -198,12 +466,8 @@ class RFID:
             self.dev_write(0x09, data[i])
         self.dev_write(0x01, self.mode_crc)
 
-        i = 255
-        while True:
-            n = self.dev_read(0x05)
-            i -= 1
-            if not ((i != 0) and not (n & 0x04)):
-                break
+        if self.wait_irq(0x05, 0x04, self.monotonic() + self.timeout) is None:
+            self.set_error(self.err_crc_timeout)
 
         ret_data = [
             self.dev_read(0x22),
@@ -212,14 +476,15 @@ class RFID:
 
         return ret_data
 
-    def select_tag(self, uid):
+    def select_tag(self, uid, cascade_level=act_select):
         """
         Selects tag for further usage.
-        uid -- list or tuple with four bytes tag ID
+        uid -- list or tuple with four bytes tag ID and BCC, as returned by anticoll
+        cascade_level -- act_select or act_select2
         Returns error state.
         """
         buf = [
-            self.act_select,
+            cascade_level,
             0x70
         ]
 
@@ -339,6 +604,8 @@ class RFID:
 
     def reset(self):
         self.dev_write(0x01, self.mode_reset)
+        if self.shadow is not None:
+            self.shadow = dict(self.shadow_reset_values)
 
     def cleanup(self):
         """
@@ -346,6 +613,5 @@ class RFID:
         """
         if self.authed:
             self.stop_crypto()
-        GPIO.cleanup()
-        SPI.closeSPI()
+        self.transport.close()
 
@@ -0,0 +1,166 @@
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import threading
+
+from flask import send_from_directory
+
+import util
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+"""
+
+Static asset handling for the web interface: content hashed URLs that can be cached
+forever by the browser, and precompressed variants served according to Accept-Encoding.
+
+"""
+
+logger = logging.getLogger(__name__)
+
+# file types worth compressing; fonts in woff format and images are compressed already
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.map', '.svg', '.ttf', '.eot', '.html', '.txt'}
+
+# cache lifetime for versioned URLs (one year) and for unversioned ones
+MAX_AGE_VERSIONED = 365 * 24 * 3600
+MAX_AGE_UNVERSIONED = 0
+
+
+class StaticAssets(object):
+    """
+    Versions, precompresses and serves static files
+    """
+
+    def __init__(self, static_folder, cache_folder):
+        # directory with original static files
+        self.static_folder = static_folder
+
+        # directory for precompressed variants, mirroring the static folder
+        self.cache_folder = cache_folder
+
+        # file name -> (mtime_ns, size, version)
+        self.versions = dict()
+
+        self.lock = threading.Lock()
+
+    def encodings(self):
+        """
+        Get supported content encodings with file suffixes, in order of preference
+        """
+        out = []
+        if brotli is not None:
+            out.append(('br', '.br'))
+        out.append(('gzip', '.gz'))
+        return out
+
+    def version(self, filename):
+        """
+        Get short content hash of a static file, to be used in URLs
+        """
+        file_path = os.path.join(self.static_folder, filename)
+        try:
+            stat_result = os.stat(file_path)
+        except OSError:
+            return None
+
+        with self.lock:
+            cached = self.versions.get(filename)
+        if cached and cached[0] == stat_result.st_mtime_ns and cached[1] == stat_result.st_size:
+            return cached[2]
+
+        m = hashlib.md5()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(64 * 1024), b''):
+                m.update(block)
+        version = m.hexdigest()[:12]
+
+        with self.lock:
+            self.versions[filename] = (stat_result.st_mtime_ns, stat_result.st_size, version)
+
+        return version
+
+    def precompress(self):
+        """
+        Create compressed variants of all compressible static files that are missing or outdated
+        """
+        count = 0
+        for dir_path, _, file_names in os.walk(self.static_folder):
+            for file_name in file_names:
+                if os.path.splitext(file_name)[1] not in COMPRESSIBLE_EXTENSIONS:
+                    continue
+
+                source = os.path.join(dir_path, file_name)
+                relative = os.path.relpath(source, self.static_folder)
+                source_mtime = os.stat(source).st_mtime
+
+                data = None
+                for encoding, suffix in self.encodings():
+                    target = os.path.join(self.cache_folder, relative + suffix)
+                    try:
+                        if os.stat(target).st_mtime >= source_mtime:
+                            continue
+                    except OSError:
+                        pass
+
+                    if data is None:
+                        with open(source, 'rb') as f:
+                            data = f.read()
+
+                    if encoding == 'br':
+                        compressed = brotli.compress(data, quality=11)
+                    else:
+                        compressed = gzip.compress(data, compresslevel=9)
+
+                    try:
+                        util.write_file_atomic(target, compressed)
+                        count += 1
+                    except OSError as e:
+                        logger.error('Could not write compressed asset "%s": %s', target, e)
+
+        logger.info('Precompressed %d static asset variants', count)
+
+    def send(self, filename, request):
+        """
+        Serve a static file, preferring a precompressed variant accepted by the client
+        """
+        versioned = request.args.get('v') is not None and request.args.get('v') == self.version(filename)
+        max_age = MAX_AGE_VERSIONED if versioned else MAX_AGE_UNVERSIONED
+
+        response = None
+        if os.path.splitext(filename)[1] in COMPRESSIBLE_EXTENSIONS:
+            for encoding, suffix in self.encodings():
+                if encoding not in request.accept_encodings:
+                    continue
+
+                # only use variants that are up to date with the original
+                try:
+                    if (os.stat(os.path.join(self.cache_folder, filename + suffix)).st_mtime <
+                            os.stat(os.path.join(self.static_folder, filename)).st_mtime):
+                        continue
+                except OSError:
+                    continue
+
+                response = send_from_directory(self.cache_folder, filename + suffix, max_age=max_age)
+
+                # mime type of the original file, not of the compressed one
+                response.mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+                response.headers['Content-Encoding'] = encoding
+                break
+
+        if response is None:
+            response = send_from_directory(self.static_folder, filename, max_age=max_age)
+
+        response.vary.add('Accept-Encoding')
+        if versioned:
+            response.cache_control.public = True
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+
+        return response
@@ -0,0 +1,241 @@
+import binascii
+import json
+import logging
+import os
+import tarfile
+import tempfile
+import time
+
+import util
+
+"""
+
+Backup and restore of the music library together with tag metadata, as tar archive.
+
+The archive starts with a JSON member (METADATA_NAME) holding the music files with
+their content fingerprints, the fingerprint aliases of older name based hashes and
+the tag UID assignments, followed by the music files below 'music/'.
+
+Backups are generated on the fly: tar headers are built per file and file content is
+streamed in blocks, so memory use does not depend on library size and no copy of the
+archive is written to disk.
+
+Restoring reads the archive as a stream as well. Files already present with the same
+content fingerprint (also under another name) are skipped, all others are written to
+a temporary file next to their destination and moved into place once complete.
+
+"""
+
+logger = logging.getLogger(__name__)
+
+# name of the metadata member, always the first member of the archive
+METADATA_NAME = 'nfcmusik-backup.json'
+
+# directory of music files in the archive
+MUSIC_DIR = 'music/'
+
+# version of the metadata format
+METADATA_VERSION = 1
+
+# size of blocks read from music files and request streams (bytes)
+CHUNK_SIZE = 64 * 1024
+
+
+class BackupError(Exception):
+    """
+    Archive is not a valid backup
+    """
+    pass
+
+
+def make_metadata(files, aliases, tags):
+    """
+    Create metadata of a backup
+
+    :param files: list of (file name relative to MUSIC_ROOT, fingerprint) of the music files
+    :param aliases: dict of alias -> fingerprint, see FingerprintEngine
+    :param tags: list of (tag UID, tag data) assignments, see TagStore
+    """
+    return dict(
+        version=METADATA_VERSION,
+        created=int(time.time()),
+        files=[dict(name=name, hash=binascii.b2a_hex(file_hash).decode()) for name, file_hash in files],
+        aliases={binascii.b2a_hex(alias).decode(): binascii.b2a_hex(file_hash).decode()
+                 for alias, file_hash in aliases.items()},
+        tags={binascii.b2a_hex(uid).decode(): binascii.b2a_hex(data).decode() for uid, data in tags},
+    )
+
+
+def tar_header(name, size, mtime):
+    """
+    Get tar header block(s) of a regular file
+    """
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(mtime)
+    info.mode = 0o644
+    # PAX format for long and non-ASCII file names
+    return info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+
+
+def padding(size):
+    """
+    Get zero bytes filling up member data of the given size to a full tar block
+    """
+    return bytes(-size % tarfile.BLOCKSIZE)
+
+
+def generate(music_root, metadata):
+    """
+    Generate a backup archive, yield blocks of bytes
+
+    Files that vanish while the backup runs are left out; files that shrink are filled
+    up with zero bytes to keep the archive consistent.
+    """
+    content = json.dumps(metadata, indent=1, sort_keys=True).encode()
+    yield tar_header(METADATA_NAME, len(content), metadata['created'])
+    yield content + padding(len(content))
+
+    for entry in metadata['files']:
+        file_name = entry['name']
+        try:
+            f = open(util.safe_join(music_root, file_name), 'rb')
+        except (OSError, ValueError) as e:
+            logger.error('Could not back up music file "%s": %s', file_name, e)
+            continue
+
+        with f:
+            stat_result = os.fstat(f.fileno())
+            size = stat_result.st_size
+            yield tar_header(MUSIC_DIR + file_name, size, stat_result.st_mtime)
+
+            remaining = size
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    logger.error('Music file "%s" was truncated during backup', file_name)
+                    chunk = bytes(remaining)
+                remaining -= len(chunk)
+                yield chunk
+
+            yield padding(size)
+
+    # end of archive: two zero blocks
+    yield bytes(2 * tarfile.BLOCKSIZE)
+
+
+def read_metadata(archive):
+    """
+    Read metadata from the first member of an archive opened in stream mode
+    """
+    member = archive.next()
+    if member is None or member.name != METADATA_NAME or not member.isfile():
+        raise BackupError('Not an nfcmusik backup')
+
+    try:
+        metadata = json.loads(archive.extractfile(member).read().decode())
+    except ValueError as e:
+        raise BackupError('Invalid backup metadata: %s' % e)
+
+    if not isinstance(metadata, dict):
+        raise BackupError('Invalid backup metadata: unexpected structure')
+
+    if metadata.get('version') != METADATA_VERSION:
+        raise BackupError('Unsupported backup version: %s' % metadata.get('version'))
+
+    if not isinstance(metadata.get('files', []), list) or \
+            not all(isinstance(metadata.get(key, dict()), dict) for key in ('aliases', 'tags')):
+        raise BackupError('Invalid backup metadata: unexpected structure')
+
+    return metadata
+
+
+def write_member(archive, member, file_path):
+    """
+    Write content of an archive member to a file, atomically
+    """
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), prefix='.restore-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            source = archive.extractfile(member)
+            while True:
+                chunk = source.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.utime(tmp_path, (member.mtime, member.mtime))
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def restore(stream, music_root, extensions, fingerprint, present=()):
+    """
+    Restore music files from a backup archive read from a file-like object
+
+    :param stream: file-like object providing the archive, read sequentially
+    :param music_root: directory to restore music files to
+    :param extensions: allowed music file extensions
+    :param fingerprint: function (file path, os.stat result) -> content fingerprint
+    :param present: fingerprints of music files already in the library, possibly under other names
+    :return: (metadata, dict with numbers of restored, skipped and rejected files)
+    """
+    counts = dict(restored=0, skipped=0, rejected=0)
+
+    try:
+        with tarfile.open(fileobj=stream, mode='r|') as archive:
+            metadata = read_metadata(archive)
+
+            # fingerprints by file name, for skipping files already present
+            hashes = {entry['name']: entry['hash'] for entry in metadata.get('files', [])}
+
+            while True:
+                member = archive.next()
+                if member is None:
+                    break
+
+                # members are not needed afterwards, do not collect them
+                archive.members = []
+
+                file_name = member.name[len(MUSIC_DIR):] if member.name.startswith(MUSIC_DIR) else None
+                try:
+                    if not member.isfile() or not file_name:
+                        raise ValueError('not a music file')
+                    if os.path.splitext(file_name)[1] not in extensions:
+                        raise ValueError('invalid file type')
+                    file_path = util.safe_join(music_root, file_name)
+                except ValueError as e:
+                    logger.warning('Restore: skipping archive member "%s": %s', member.name, e)
+                    counts['rejected'] += 1
+                    continue
+
+                if file_name in hashes and binascii.a2b_hex(hashes[file_name]) in present:
+                    # same content already in the library, data is skipped when reading the next member
+                    counts['skipped'] += 1
+                    continue
+
+                try:
+                    stat_result = os.stat(file_path)
+                except FileNotFoundError:
+                    stat_result = None
+
+                if stat_result is not None and stat_result.st_size == member.size and file_name in hashes:
+                    if binascii.b2a_hex(fingerprint(file_path, stat_result)).decode() == hashes[file_name]:
+                        # same content already present (changed since the library was scanned)
+                        counts['skipped'] += 1
+                        continue
+
+                write_member(archive, member, file_path)
+                counts['restored'] += 1
+    except tarfile.TarError as e:
+        raise BackupError('Invalid backup archive: %s' % e)
+
+    return metadata, counts
@@ -0,0 +1,300 @@
+import sys
+import types
+
+"""
+
+Fake hardware for running the RFID driver and the controller without a RasPi.
+
+Provides stand-ins for the `spi`, `RPi.GPIO` and `pygame` modules. SPI transfers
+go to a simulated RC522 reader with an optional NTAG213-like tag in its field,
+which understands the commands used by RFID.py (REQA, anticollision, select,
+read, write, halt) and the CRC coprocessor. Every SPI transaction is counted.
+
+Call install() before importing RFID, controller or web.
+
+"""
+
+
+def crc_a(data):
+    """
+    ISO 14443-3 CRC_A, bitwise reference implementation
+    """
+    crc = 0x6363
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            if crc & 0x0001:
+                crc = (crc >> 1) ^ 0x8408
+            else:
+                crc >>= 1
+    return [crc & 0xFF, crc >> 8]
+
+
+class FakeTag(object):
+    """
+    NFC tag with 4-byte pages, NTAG213 style
+
+    UIDs have 4 bytes (single size) or 7 bytes (double size, two cascade levels as
+    with real NTAG213 tags).
+    """
+
+    def __init__(self, uid=(0x04, 0xA2, 0x3B, 0x7C), pages=45):
+        assert len(uid) in (4, 7)
+        self.uid = list(uid)
+        self.memory = [0] * (4 * pages)
+
+        # page number of a pending two-step write, see FakeRC522.transceive
+        self.write_page = None
+
+        # cascade level 1 selected, double size UIDs only
+        self.cascade_selected = False
+
+    def cascade_uid(self, level):
+        """
+        Get UID bytes and BCC sent during anticollision of cascade level 1 or 2
+        """
+        if len(self.uid) == 4:
+            uid = self.uid
+        elif level == 1:
+            uid = [0x88] + self.uid[:3]
+        else:
+            uid = self.uid[3:]
+        return uid + [uid[0] ^ uid[1] ^ uid[2] ^ uid[3]]
+
+    def respond(self, frame):
+        """
+        Get response to a frame as (data, number of valid bits in last byte), or None for no response
+        """
+        if self.write_page is not None:
+            page = self.write_page
+            self.write_page = None
+            if len(frame) == 18 and crc_a(frame[:16]) == frame[16:]:
+                self.memory[4 * page:4 * page + 4] = frame[:4]
+                return [0x0A], 4
+            return None
+
+        if frame == [0x26] or frame == [0x52]:
+            self.cascade_selected = False
+            return [0x44 if len(self.uid) == 7 else 0x04, 0x00], 0
+        if frame == [0x93, 0x20]:
+            return self.cascade_uid(1), 0
+        if frame == [0x95, 0x20] and self.cascade_selected:
+            return self.cascade_uid(2), 0
+        if len(frame) < 2 or crc_a(frame[:-2]) != frame[-2:]:
+            return None
+
+        if frame[:2] == [0x93, 0x70] and frame[2:7] == self.cascade_uid(1):
+            # SAK: cascade bit set while the UID is not complete
+            sak = 0x04 if len(self.uid) == 7 else 0x00
+            self.cascade_selected = len(self.uid) == 7
+            return [sak] + crc_a([sak]), 0
+        if frame[:2] == [0x95, 0x70] and self.cascade_selected and frame[2:7] == self.cascade_uid(2):
+            return [0x00] + crc_a([0x00]), 0
+
+        command = frame[0]
+        if command == 0x30:
+            page = frame[1]
+            data = [self.memory[(4 * page + i) % len(self.memory)] for i in range(16)]
+            return data + crc_a(data), 0
+        if command == 0xA0:
+            self.write_page = frame[1]
+            return [0x0A], 4
+
+        # HLTA and everything else: no response
+        return None
+
+
+class FakeRC522(object):
+    """
+    Register level simulation of the MFRC522 reader
+    """
+
+    def __init__(self, tag=None):
+        # tag in the field, or None
+        self.tag = tag
+
+        # number of SPI transactions
+        self.transfers = 0
+
+        self.reset()
+
+    def reset(self):
+        self.registers = [0] * 64
+        self.registers[0x02] = 0x80
+        self.registers[0x11] = 0x3F
+        self.registers[0x14] = 0x80
+        self.fifo = []
+        self.command = 0x00
+        self.last_bits = 0
+
+    def transfer(self, data):
+        """
+        Handle one SPI transaction of (address byte, value)
+        """
+        self.transfers += 1
+        address = (data[0] >> 1) & 0x3F
+
+        if data[0] & 0x80:
+            return (0, self.read(address))
+
+        self.write(address, data[1])
+        return (0, 0)
+
+    def read(self, address):
+        if address == 0x09:
+            return self.fifo.pop(0) if self.fifo else 0
+        if address == 0x0A:
+            return len(self.fifo)
+        if address == 0x0C:
+            return (self.registers[0x0C] & 0xF8) | self.last_bits
+        return self.registers[address]
+
+    def write(self, address, value):
+        if address == 0x01:
+            self.command = value & 0x0F
+            if self.command == 0x0F:
+                self.reset()
+            elif self.command == 0x03:
+                # CRC coprocessor works on the FIFO content
+                crc = crc_a(self.fifo)
+                self.fifo = []
+                self.registers[0x22] = crc[0]
+                self.registers[0x21] = crc[1]
+                self.registers[0x05] |= 0x04
+                self.command = 0x00
+        elif address == 0x09:
+            self.fifo.append(value)
+        elif address == 0x0A:
+            if value & 0x80:
+                self.fifo = []
+        elif address in (0x04, 0x05):
+            # bit 7 selects whether the marked bits are set or cleared
+            if value & 0x80:
+                self.registers[address] |= value & 0x7F
+            else:
+                self.registers[address] &= ~value & 0x7F
+        else:
+            self.registers[address] = value
+            if address == 0x0D and value & 0x80 and self.command == 0x0C:
+                self.transceive()
+
+    def transceive(self):
+        """
+        Send FIFO content to the tag, put response into FIFO
+        """
+        frame = self.fifo
+        self.fifo = []
+
+        response = self.tag.respond(frame) if self.tag is not None else None
+        if response is None:
+            # no answer: the timer runs out
+            self.registers[0x04] |= 0x01
+            return
+
+        self.fifo, self.last_bits = list(response[0]), response[1]
+        self.registers[0x04] |= 0x30
+
+
+class FakeGPIO(types.ModuleType):
+    """
+    RPi.GPIO stand-in
+    """
+
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    HIGH = 1
+    LOW = 0
+    PUD_UP = 22
+    FALLING = 32
+
+    def __init__(self):
+        super().__init__('RPi.GPIO')
+        self.pins = dict()
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=None):
+        self.pins.setdefault(pin, 1)
+
+    def output(self, pin, value):
+        self.pins[pin] = value
+
+    def input(self, pin):
+        return self.pins.get(pin, 1)
+
+    def wait_for_edge(self, pin, edge, timeout=None):
+        # the simulated reader finishes commands immediately
+        return pin
+
+    def cleanup(self, *args):
+        pass
+
+
+class FakeSPI(types.ModuleType):
+    """
+    spi (SPI-Py) stand-in, forwarding transfers to a FakeRC522
+    """
+
+    def __init__(self, chip):
+        super().__init__('spi')
+        self.chip = chip
+
+    def openSPI(self, device='/dev/spidev0.0', speed=1000000, **kwargs):
+        pass
+
+    def closeSPI(self):
+        pass
+
+    def transfer(self, data):
+        return self.chip.transfer(data)
+
+
+def make_pygame():
+    """
+    Create a silent pygame stand-in, providing pygame.mixer.music
+    """
+    pygame = types.ModuleType('pygame')
+    mixer = types.ModuleType('pygame.mixer')
+    music = types.ModuleType('pygame.mixer.music')
+
+    state = dict(busy=False)
+
+    music.load = lambda file_path: None
+    music.play = lambda *args, **kwargs: state.update(busy=True)
+    music.stop = lambda: state.update(busy=False)
+    music.get_busy = lambda: state['busy']
+    music.get_pos = lambda: 0
+
+    mixer.init = lambda *args, **kwargs: None
+    mixer.music = music
+
+    pygame.mixer = mixer
+    pygame.error = type('error', (RuntimeError,), dict())
+    return pygame
+
+
+def install(tag=None):
+    """
+    Register fake hardware modules in sys.modules, return the simulated reader
+    """
+    chip = FakeRC522(tag)
+
+    gpio = FakeGPIO()
+    rpi = types.ModuleType('RPi')
+    rpi.GPIO = gpio
+    pygame = make_pygame()
+
+    sys.modules['RPi'] = rpi
+    sys.modules['RPi.GPIO'] = gpio
+    sys.modules['spi'] = FakeSPI(chip)
+    sys.modules['pygame'] = pygame
+    sys.modules['pygame.mixer'] = pygame.mixer
+    sys.modules['pygame.mixer.music'] = pygame.mixer.music
+
+    return chip
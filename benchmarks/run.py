@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+"""
+
+Benchmark suite, runs without hardware on top of benchmarks/fakehw.py.
+
+Measures wall time and SPI transactions of the RFID protocol functions, the
+RFIDHandler poll cycle and tag writing, and requests/sec of the JSON endpoints
+for different music library sizes.
+
+Usage:
+python3 benchmarks/run.py --output results.json
+python3 benchmarks/run.py --compare results.json
+
+"""
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+sys.path.insert(0, BENCHMARK_DIR)
+
+import fakehw
+
+# simulated reader, with a tag in the field
+chip = fakehw.install(fakehw.FakeTag())
+
+import RFID
+import settings
+import spitrace
+
+# library sizes for the web endpoint benchmarks
+LIBRARY_SIZES = (10, 100, 1000, 10000)
+
+
+def measure(func, min_time=0.5, min_runs=5):
+    """
+    Call func repeatedly for at least min_time seconds and min_runs times
+
+    :return: dict with wall time per call (microseconds), calls per second and SPI transactions per call
+    """
+    runs = 0
+    transfers = chip.transfers
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < min_time or runs < min_runs:
+        func()
+        runs += 1
+        elapsed = time.perf_counter() - start
+
+    return dict(
+        runs=runs,
+        wall_time_us=elapsed / runs * 1e6,
+        ops_per_second=runs / elapsed,
+        spi_transactions=(chip.transfers - transfers) / runs,
+    )
+
+
+def bench_rfid(min_time):
+    """
+    RFID protocol functions, on one reader instance
+    """
+    rdr = RFID.RFID()
+    payload = list(range(16))
+
+    out = dict()
+    out['rfid.init'] = measure(lambda: RFID.RFID().cleanup(), min_time)
+    out['rfid.request'] = measure(rdr.request, min_time)
+    out['rfid.anticoll'] = measure(rdr.anticoll, min_time)
+    out['rfid.read'] = measure(lambda: rdr.read(10), min_time)
+    out['rfid.write'] = measure(lambda: rdr.write(10, payload), min_time)
+    out['rfid.calculate_crc'] = measure(lambda: rdr.calculate_crc([0x30, 10]), min_time)
+    out['rfid.calculate_crc_hw'] = measure(lambda: rdr.calculate_crc_hw([0x30, 10]), min_time)
+    out['rfid.crc_a[16]'] = measure(lambda: RFID.crc_a(payload), min_time)
+
+    rdr.cleanup()
+
+    # same commands without the register shadow, for comparison
+    rdr = RFID.RFID(shadow=False)
+    out['rfid.init[noshadow]'] = measure(lambda: RFID.RFID(shadow=False).cleanup(), min_time)
+    out['rfid.request[noshadow]'] = measure(rdr.request, min_time)
+    out['rfid.anticoll[noshadow]'] = measure(rdr.anticoll, min_time)
+    out['rfid.read[noshadow]'] = measure(lambda: rdr.read(10), min_time)
+    out['rfid.write[noshadow]'] = measure(lambda: rdr.write(10, payload), min_time)
+    rdr.cleanup()
+
+    out.update(bench_trace(min_time))
+
+    return out
+
+
+def poll_session(rdr):
+    """
+    One poll cycle worth of reader commands
+    """
+    rdr.request()
+    rdr.anticoll()
+    rdr.read(10)
+    rdr.cleanup()
+
+
+def bench_trace(min_time):
+    """
+    Poll sessions without and with SPI recording, and replay of the recording
+    """
+    out = dict()
+    out['rfid.poll_session'] = measure(lambda: poll_session(RFID.RFID()), min_time)
+
+    trace_path = os.path.join(settings.DATA_ROOT, 'benchmark.spitrace')
+    recorder = spitrace.SPIRecorder(trace_path)
+    out['rfid.poll_session[recording]'] = measure(lambda: poll_session(RFID.RFID(recorder=recorder)), min_time)
+    recorder.flush()
+
+    transport = spitrace.ReplayTransport(trace_path)
+    sessions = out['rfid.poll_session[recording]']['runs']
+
+    def replay():
+        for _ in range(sessions):
+            poll_session(RFID.RFID(transport=transport))
+
+    result = measure(replay, 0, min_runs=1)
+    if transport.remaining() != 0:
+        raise AssertionError('Replay did not consume the trace, %d transactions left' % transport.remaining())
+    result['wall_time_us'] /= sessions
+    result['ops_per_second'] *= sessions
+    out['rfid.poll_session[replay]'] = result
+
+    return out
+
+
+def make_handler():
+    """
+    Create RFIDHandler with audio output and WiFi shutdown disabled
+    """
+    import controller
+    import util
+
+    # no amixer off-device
+    util.set_volume = lambda percentage: None
+
+    settings.START_SOUND = None
+    settings.WLAN_OFF_DELAY = 1e9
+
+    handler = controller.RFIDHandler()
+
+    # tag carries a music file payload, so the poll cycle goes all the way through action()
+    payload = settings.CONTROL_BYTES['MUSIC_FILE'] + bytes(range(1, 16))
+    chip.tag.memory[4 * handler.page:4 * handler.page + 16] = list(payload)
+    handler.set_music_files_dict({payload: 'benchmark.mp3'})
+
+    return handler
+
+
+def bench_handler(handler, min_time):
+    """
+    RFIDHandler poll cycle and tag writing
+    """
+    out = dict()
+
+    # run poll_loop for a fixed number of cycles, without sleeping in between
+    cycles = 20
+    handler.sleep = 0
+    action = handler.action
+    count = [0]
+
+    def counting_action():
+        action()
+        count[0] += 1
+        if count[0] >= cycles:
+            handler.stop_polling()
+
+    handler.action = counting_action
+
+    def poll():
+        count[0] = 0
+        handler.do_stop = False
+        handler.poll_loop()
+
+    def measure_poll():
+        result = measure(poll, min_time, min_runs=1)
+        for key in ('wall_time_us', 'spi_transactions'):
+            result[key] /= cycles
+        result['ops_per_second'] *= cycles
+        return result
+
+    out['handler.poll_cycle'] = measure_poll()
+
+    # tag assigned by UID: no page read
+    data = bytes(chip.tag.memory[4 * handler.page:4 * handler.page + 16])
+    handler.assign_uid(bytes(chip.tag.uid), data)
+    out['handler.poll_cycle[uid]'] = measure_poll()
+    handler.unassign_uid(bytes(chip.tag.uid))
+
+    # 7 byte UID, as NTAG213: second cascade level
+    tag = chip.tag
+    chip.tag = fakehw.FakeTag(uid=(0x04, 0xA2, 0x3B, 0x7C, 0x91, 0x5E, 0x80))
+    chip.tag.memory = tag.memory
+    handler.assign_uid(bytes(chip.tag.uid), data)
+    out['handler.poll_cycle[uid7]'] = measure_poll()
+    handler.unassign_uid(bytes(chip.tag.uid))
+    chip.tag = tag
+
+    handler.action = action
+
+    payload = bytes(range(16))
+    out['handler.write'] = measure(lambda: handler.write(payload), min_time)
+
+    return out
+
+
+def make_library(root, size):
+    """
+    Create a music library of small files with distinct content (and thus fingerprints)
+    """
+    for i in range(size):
+        with open(os.path.join(root, 'Track {:05d}.mp3'.format(i)), 'wb') as f:
+            f.write(str(i).encode())
+
+
+def bench_web(handler, min_time):
+    """
+    Requests/sec of the JSON endpoints for several library sizes
+    """
+    import fingerprint
+    import scanner
+    import web
+
+    web.rfid_handler = handler
+    client = web.app.test_client()
+
+    out = dict()
+    for size in LIBRARY_SIZES:
+        music_root = tempfile.mkdtemp(prefix='nfcmusik-bench-music-')
+        try:
+            make_library(music_root, size)
+            settings.MUSIC_ROOT = music_root
+            web.library_scanner = scanner.LibraryScanner(music_root, settings.ALLOWED_EXTENSIONS,
+                                                         max_workers=settings.SCAN_WORKERS)
+            web.fingerprint_engine = fingerprint.FingerprintEngine()
+
+            # initial scan, measured separately
+            start = time.perf_counter()
+            web.refresh_music_files()
+            out['web.initial_scan[{:d}]'.format(size)] = dict(wall_time_us=(time.perf_counter() - start) * 1e6)
+
+            out['web.musicfiles[{:d}]'.format(size)] = measure(
+                lambda: client.get('/json/musicfiles').close(), min_time)
+            out['web.library[{:d}]'.format(size)] = measure(
+                lambda: client.get('/json/library').close(), min_time)
+            out['web.library_search[{:d}]'.format(size)] = measure(
+                lambda: client.get('/json/library?q=track 001').close(), min_time)
+            out['web.readnfc[{:d}]'.format(size)] = measure(
+                lambda: client.get('/json/readnfc').close(), min_time)
+        finally:
+            shutil.rmtree(music_root)
+
+    return out
+
+
+def compare(results, baseline):
+    """
+    Print relative change of wall time and SPI transactions per benchmark
+    """
+    print('{:32s} {:>12s} {:>12s} {:>7s} {:>9s} {:>9s}'.format(
+        'benchmark', 'before (us)', 'after (us)', 'ratio', 'SPI before', 'SPI after'))
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        old = baseline[name]['wall_time_us']
+        new = result['wall_time_us']
+        print('{:32s} {:12.1f} {:12.1f} {:7.2f} {:9.1f} {:9.1f}'.format(
+            name, old, new, new / old if old else 0.0,
+            baseline[name].get('spi_transactions', 0.0), result.get('spi_transactions', 0.0)))
+
+
+def main(args):
+    # the simulated music file does not exist, do not flood the output with errors
+    logging.basicConfig(level=logging.CRITICAL)
+
+    # runtime data (fingerprint cache, tag mappings, ...) goes to a temporary directory
+    settings.DATA_ROOT = tempfile.mkdtemp(prefix='nfcmusik-bench-data-')
+
+    results = dict()
+    try:
+        results.update(bench_rfid(args.min_time))
+
+        handler = make_handler()
+        results.update(bench_handler(handler, args.min_time))
+
+        if not args.skip_web:
+            results.update(bench_web(handler, args.min_time))
+    finally:
+        shutil.rmtree(settings.DATA_ROOT)
+
+    out = dict(
+        meta=dict(
+            python=platform.python_version(),
+            machine=platform.machine(),
+            time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        ),
+        results=results,
+    )
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(out, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(out, indent=2, sort_keys=True))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='NFC Music Box Benchmarks')
+    parser.add_argument('-o', '--output', help='write results as JSON to this file')
+    parser.add_argument('-c', '--compare', help='compare with results of an earlier run')
+    parser.add_argument('--min-time', type=float, default=0.5, help='minimum time per benchmark (seconds)')
+    parser.add_argument('--skip-web', action='store_true', help='skip web endpoint benchmarks')
+
+    main(parser.parse_args())
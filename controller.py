@@ -11,7 +11,10 @@ from multiprocessing import Process, Lock, Manager
 import pygame
 
 import RFID
+import resume
 import settings
+import spitrace
+import tagstore
 import util
 import web
 
@@ -45,8 +48,8 @@ class RFIDHandler(object):
         # manager for interprocess data sharing (polling process writes uid/data)
         self.manager = Manager()
 
-        # current tag uid
-        self.uid = self.manager.list(range(5))
+        # current tag uid - 4 or 7 bytes
+        self.uid = self.manager.list([None])
 
         # current tag data - 16 bytes
         self.data = self.manager.list(range(16))
@@ -54,6 +57,17 @@ class RFIDHandler(object):
         # music files dictionary
         self.music_files_dict = self.manager.dict()
 
+        # last dictionary passed to set_music_files_dict (web server process)
+        self.music_files_pushed = None
+
+        # tag UID -> music file hash mappings, persisted in the tag store (only accessed by
+        # the web server process) and shared with the polling process
+        self.tag_store = tagstore.TagStore(os.path.join(settings.DATA_ROOT, 'tags.json'))
+        self.uid_map = self.manager.dict(self.tag_store.items())
+
+        # RFID error counts by error name, as seen by the polling process
+        self.rfid_errors = self.manager.dict()
+
         # startup time or last server interaction
         self.startup = datetime.datetime.now()
 
@@ -76,6 +90,13 @@ class RFIDHandler(object):
         # last played music file
         self.previous_music = None
 
+        # position (seconds) the current music file was started at
+        self.music_start = 0.0
+
+        # playback positions for resuming music files, only used by the polling process
+        self.positions = resume.PositionJournal(os.path.join(settings.DATA_ROOT, 'positions.journal'),
+                                                flush_interval=settings.RESUME_FLUSH_INTERVAL)
+
         # must have seen stop signal N times to stop music - avoid
         # stopping if signal drops out briefly
         self.stop_music_on_stop_count = 3
@@ -88,6 +109,13 @@ class RFIDHandler(object):
         # stop signal counter
         self.stop_count = 0
 
+    def reader(self):
+        """
+        Create RFID interface instance, recording SPI transactions if configured
+        """
+        recorder = spitrace.get_recorder(settings.SPI_TRACE_FILE) if settings.SPI_TRACE_FILE else None
+        return RFID.RFID(pin_irq=settings.RFID_IRQ_PIN, recorder=recorder)
+
     def poll_loop(self):
         """
         Poll for presence of tag, read data, until stop() is called.
@@ -109,55 +137,68 @@ class RFIDHandler(object):
             except pygame.error as e:
                 logger.error('Start sound could not be played: %s', e)
 
-        while not self.do_stop:
-            with self.mutex:
-
-                # initialize tag state
-                self.uid[0] = None
-                self.data[0] = None
-
-                # always create a new RFID interface instance, to clear any errors from
-                # previous operations
-                rdr = RFID.RFID()
+        try:
+            while not self.do_stop:
+                with self.mutex:
 
-                # check for presence of tag
-                err, _ = rdr.request()
+                    # initialize tag state
+                    self.uid[0] = None
+                    self.data[0] = None
 
-                if not err:
-                    logger.debug('RFIDHandler poll_loop: Tag is present')
+                    # always create a new RFID interface instance, to clear any errors from
+                    # previous operations
+                    rdr = self.reader()
 
-                    # tag is present, get UID
-                    err, uid = rdr.anticoll()
+                    # check for presence of tag
+                    err, _ = rdr.request()
 
                     if not err:
-                        logger.debug('RFIDHandler poll_loop: Read UID: ' + str(uid))
+                        logger.debug('RFIDHandler poll_loop: Tag is present')
 
-                        # read data
-                        err, data = rdr.read(self.page)
+                        # tag is present, get UID
+                        err, uid = rdr.read_uid()
 
                         if not err:
-                            logger.debug('RFIDHandler poll_loop: Read tag data: ' + str(data))
+                            logger.debug('RFIDHandler poll_loop: Read UID: ' + str(uid))
+
+                            # tags assigned by UID need no page read
+                            data = self.uid_map.get(bytes(uid))
+                            if data is not None:
+                                logger.debug('RFIDHandler poll_loop: UID is assigned')
+                            else:
+                                # read data
+                                err, data = rdr.read(self.page)
+
+                            if not err:
+                                logger.debug('RFIDHandler poll_loop: Read tag data: ' + str(data))
 
-                            # all good, store data to shared mem
-                            for i in range(5):
-                                self.uid[i] = uid[i]
-                            for i in range(16):
-                                self.data[i] = data[i]
+                                # all good, store data to shared mem
+                                self.uid[:] = uid
+                                for i in range(16):
+                                    self.data[i] = data[i]
+
+                            else:
+                                logger.error('RFIDHandler poll_loop: Error returned from read()')
 
                         else:
-                            logger.error('RFIDHandler poll_loop: Error returned from read()')
+                            logger.error('RFIDHandler poll_loop: Error returned from read_uid()')
 
-                    else:
-                        logger.error('RFIDHandler poll_loop: Error returned from anticoll()')
+                    # clean up
+                    rdr.cleanup()
 
-                # clean up
-                rdr.cleanup()
+                    # publish error counts if they changed
+                    if RFID.RFID.error_counts and \
+                            sum(RFID.RFID.error_counts.values()) != sum(self.rfid_errors.values()):
+                        self.rfid_errors.update(RFID.RFID.error_counts)
 
-                # act on data
-                self.action()
+                    # act on data
+                    self.action()
 
-            # wait a bit (this is in while loop, NOT in mutex env)
-            time.sleep(self.sleep)
+                # wait a bit (this is in while loop, NOT in mutex env)
+                time.sleep(self.sleep)
+        finally:
+            # this process exits without running atexit handlers
+            spitrace.flush_recorders()
 
     def write(self, data):
         """
@@ -170,7 +211,7 @@ class RFIDHandler(object):
 
         with self.mutex:
 
-            rdr = RFID.RFID()
+            rdr = self.reader()
 
             success = False
 
@@ -244,13 +285,62 @@ class RFIDHandler(object):
         else:
             return None
 
+    def assign_uid(self, uid, data):
+        """
+        Map a tag UID to 16 bytes of tag data (music file hash), used instead of
+        the data written to the tag
+        """
+        self.tag_store.assign(uid, data)
+        with self.mutex:
+            self.uid_map[uid] = data
+
+    def assign_uids(self, mappings):
+        """
+        Map several tag UIDs to tag data at once, e.g. when restoring a backup
+        """
+        self.tag_store.update(mappings)
+        with self.mutex:
+            self.uid_map.update(mappings)
+
+    def get_uid_assignments(self):
+        """
+        Get all tag UID assignments as list of (UID, tag data)
+        """
+        return self.tag_store.items()
+
+    def unassign_uid(self, uid):
+        """
+        Remove mapping of a tag UID, return True if there was one
+        """
+        removed = self.tag_store.remove(uid)
+        with self.mutex:
+            self.uid_map.pop(uid, None)
+        return removed
+
+    def get_uid_assignment(self, uid):
+        """
+        Get tag data mapped to a tag UID, or None
+        """
+        return self.tag_store.get(uid)
+
     def set_music_files_dict(self, mfd):
         """
         Set dictionary of file hashes and music files
         """
-        with self.mutex:
-            for k, v in mfd.items():
-                self.music_files_dict[k] = v
+        # the library is refreshed on most page loads, only push changes to the polling process
+        if mfd == self.music_files_pushed:
+            return
+
+        # one round trip to the manager, which applies it atomically - no need to hold
+        # the RFID mutex and stall polling
+        self.music_files_dict.update(mfd)
+        self.music_files_pushed = dict(mfd)
+
+    def get_rfid_errors(self):
+        """
+        Get RFID error counts of the polling process
+        """
+        return dict(self.rfid_errors)
 
     def reset_startup_timer(self):
         """
@@ -298,14 +388,19 @@ class RFIDHandler(object):
             if bin_data[0:1] == settings.CONTROL_BYTES['MUSIC_FILE']:
 
                 if bin_data in self.music_files_dict:
+                    # file name is a '/' separated path relative to MUSIC_ROOT
                     file_name = self.music_files_dict[bin_data]
-                    file_path = os.path.join(settings.MUSIC_ROOT, file_name)
 
                     if file_name != self.current_music:
+                        try:
+                            file_path = util.safe_join(settings.MUSIC_ROOT, file_name)
+                        except ValueError as e:
+                            logger.error('RFIDHandler action: %s', e)
+                            file_path = None
 
                         # only replay same music file if we saw at least N periods
                         # of no token
-                        if os.path.exists(file_path) and (
+                        if file_path is not None and os.path.exists(file_path) and (
                                 file_name != self.previous_music or self.stop_count >= self.replay_on_stop_count):
                             logger.info('RFIDHandler action: Playing music file ' + file_path)
 
@@ -314,15 +409,20 @@ class RFIDHandler(object):
                             self.previous_music = file_name
 
                             try:
-                                # load and play start sound
                                 pygame.mixer.music.load(file_path)
-                                pygame.mixer.music.play()
+                                self.play(file_name)
                             except pygame.error as e:
                                 logger.error('Audio file "%s" could not be played: %s', file_name, e)
                         else:
-                            if not os.path.exists(file_path):
+                            if file_path is not None and not os.path.exists(file_path):
                                 logger.error('RFIDHandler action: File not found ' + file_path)
 
+                    elif pygame.mixer.music.get_busy():
+                        self.checkpoint()
+                    else:
+                        # played to the end, start from the beginning next time
+                        self.positions.remove(file_name)
+
                     # token seen - reset stop counter
                     self.stop_count = 0
 
@@ -337,11 +437,51 @@ class RFIDHandler(object):
 
             # only stop after token absence for at least N times
             if self.stop_count >= self.stop_music_on_stop_count:
-                self.current_music = None
+                if self.current_music is not None:
+                    if pygame.mixer.music.get_busy():
+                        self.checkpoint()
+                    else:
+                        self.positions.remove(self.current_music)
+                    self.current_music = None
+
+                    # persist position right away, the box may be switched off next
+                    self.positions.flush()
 
                 if pygame.mixer.music.get_busy():
                     # stop music
                     pygame.mixer.music.stop()
+            elif self.current_music is not None and pygame.mixer.music.get_busy():
+                self.checkpoint()
+
+        self.positions.maybe_flush()
+
+    def play(self, file_name):
+        """
+        Play loaded music file, from the saved position if there is one
+        """
+        position = self.positions.get(file_name)
+        if position is not None and position >= settings.RESUME_MIN_POSITION:
+            # go back a little, for context and to make up for the position lagging behind
+            self.music_start = max(0.0, position - settings.RESUME_REWIND)
+            try:
+                logger.info('Resuming at %.1f seconds', self.music_start)
+                pygame.mixer.music.play(start=self.music_start)
+                return
+            except pygame.error as e:
+                # not seekable (depends on format and SDL_mixer version)
+                logger.warning('Audio file "%s" could not be resumed: %s', file_name, e)
+
+        self.music_start = 0.0
+        pygame.mixer.music.play()
+
+    def checkpoint(self):
+        """
+        Save playback position of the current music file (in memory, written in batches)
+        """
+        # milliseconds since play() was called, -1 if not playing
+        elapsed = pygame.mixer.music.get_pos()
+        if elapsed >= 0:
+            self.positions.set(self.current_music, self.music_start + elapsed / 1000.0)
 
 
 def main(args):
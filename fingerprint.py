@@ -0,0 +1,224 @@
+import binascii
+import hashlib
+import json
+import logging
+import os
+import struct
+import threading
+import time
+
+import settings
+import util
+
+"""
+
+Content fingerprints for music files.
+
+A fingerprint is an MD5 over the file size and a few sampled blocks of the file
+(head, tail and evenly strided blocks from the middle), so it survives renames
+and re-uploads under a different name but is cheap to compute even for large
+audiobook files. Like the name based hashes, the first byte is replaced with the
+music file control byte, so fingerprints can be written to tags directly.
+
+Fingerprints are cached by inode, mtime and size, so unchanged files are never
+read twice. The alias table maps older identifiers (name based hashes) to
+fingerprints, so tags written before a rename keep working.
+
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class FingerprintEngine(object):
+    """
+    Computes, caches and persists content fingerprints of music files
+    """
+
+    def __init__(self, cache_file=None, block_size=None, middle_blocks=None):
+        # JSON file for persisting cache and alias table
+        self.cache_file = cache_file
+
+        # size of sampled blocks and number of blocks sampled from the middle
+        self.block_size = block_size or settings.FINGERPRINT_BLOCK_SIZE
+        self.middle_blocks = middle_blocks if middle_blocks is not None else settings.FINGERPRINT_MIDDLE_BLOCKS
+
+        # (inode, mtime_ns, size) -> fingerprint
+        self.cache = dict()
+
+        # alias (e.g. name based hash) -> fingerprint
+        self.aliases = dict()
+
+        # cache keys used since the last prune
+        self.used_keys = set()
+
+        # unsaved changes?
+        self.dirty = False
+
+        # web server is threaded
+        self.lock = threading.Lock()
+
+        # statistics
+        self.hits = 0
+        self.misses = 0
+        self.bytes_read = 0
+        self.hash_time = 0.0
+
+        if cache_file:
+            self.load()
+
+    def load(self):
+        """
+        Load cache and alias table from the cache file, if present
+        """
+        try:
+            with open(self.cache_file, 'r') as f:
+                content = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error('Could not load fingerprint cache "%s": %s', self.cache_file, e)
+            return
+
+        with self.lock:
+            for inode, mtime_ns, size, fingerprint in content.get('cache', []):
+                self.cache[(inode, mtime_ns, size)] = binascii.a2b_hex(fingerprint)
+            for alias, fingerprint in content.get('aliases', dict()).items():
+                self.aliases[binascii.a2b_hex(alias)] = binascii.a2b_hex(fingerprint)
+
+    def save(self):
+        """
+        Write cache and alias table to the cache file, if anything changed
+        """
+        if not self.cache_file:
+            return
+
+        with self.lock:
+            if not self.dirty:
+                return
+            content = dict(
+                cache=[[inode, mtime_ns, size, binascii.b2a_hex(fingerprint).decode()]
+                       for (inode, mtime_ns, size), fingerprint in self.cache.items()],
+                aliases={binascii.b2a_hex(alias).decode(): binascii.b2a_hex(fingerprint).decode()
+                         for alias, fingerprint in self.aliases.items()},
+            )
+            self.dirty = False
+
+        try:
+            util.write_file_atomic(self.cache_file, json.dumps(content).encode())
+        except OSError as e:
+            logger.error('Could not save fingerprint cache "%s": %s', self.cache_file, e)
+
+    def sample_offsets(self, size):
+        """
+        Get offsets of the blocks to hash for a file of the given size
+        """
+        block = self.block_size
+        if size <= block * (self.middle_blocks + 2):
+            # small file: hash everything
+            return [(offset, min(block, size - offset)) for offset in range(0, size, block)]
+
+        offsets = [(0, block)]
+        stride = (size - 2 * block) // (self.middle_blocks + 1)
+        for i in range(1, self.middle_blocks + 1):
+            offsets.append((block + i * stride - block // 2, block))
+        offsets.append((size - block, block))
+        return offsets
+
+    def compute(self, file_path, size):
+        """
+        Compute fingerprint of a file, bypassing the cache
+        """
+        m = hashlib.md5()
+        m.update(struct.pack('<Q', size))
+
+        bytes_read = 0
+        with open(file_path, 'rb') as f:
+            for offset, length in self.sample_offsets(size):
+                f.seek(offset)
+                block = f.read(length)
+                bytes_read += len(block)
+                m.update(block)
+
+        with self.lock:
+            self.bytes_read += bytes_read
+
+        return settings.CONTROL_BYTES['MUSIC_FILE'] + m.digest()[1:]
+
+    def fingerprint(self, file_path, stat_result=None):
+        """
+        Get fingerprint of a file, from cache if inode, mtime and size are unchanged
+
+        :param file_path: path of the music file
+        :param stat_result: result of os.stat() for the file, if already at hand
+        """
+        if stat_result is None:
+            stat_result = os.stat(file_path)
+
+        key = (stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size)
+
+        with self.lock:
+            self.used_keys.add(key)
+            fingerprint = self.cache.get(key)
+            if fingerprint is not None:
+                self.hits += 1
+                return fingerprint
+            self.misses += 1
+
+        start = time.perf_counter()
+        fingerprint = self.compute(file_path, stat_result.st_size)
+        elapsed = time.perf_counter() - start
+
+        with self.lock:
+            self.hash_time += elapsed
+            self.cache[key] = fingerprint
+            self.dirty = True
+
+        return fingerprint
+
+    def prune(self):
+        """
+        Drop cache entries that were not used since the last prune, e.g. of deleted files
+        """
+        with self.lock:
+            stale = [key for key in self.cache if key not in self.used_keys]
+            for key in stale:
+                del self.cache[key]
+            if stale:
+                self.dirty = True
+            self.used_keys = set()
+
+    def add_alias(self, alias, fingerprint):
+        """
+        Register an alternative identifier for a fingerprint
+        """
+        if alias == fingerprint:
+            return
+        with self.lock:
+            if self.aliases.get(alias) != fingerprint:
+                self.aliases[alias] = fingerprint
+                self.dirty = True
+
+    def get_aliases(self):
+        """
+        Get a copy of the alias table
+        """
+        with self.lock:
+            return dict(self.aliases)
+
+    def get_stats(self):
+        """
+        Get fingerprint throughput and cache statistics
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return dict(
+                cached=len(self.cache),
+                aliases=len(self.aliases),
+                hits=self.hits,
+                misses=self.misses,
+                hit_rate=self.hits / lookups if lookups else 0.0,
+                bytes_read=self.bytes_read,
+                hash_time=self.hash_time,
+                files_per_second=self.misses / self.hash_time if self.hash_time else 0.0,
+                bytes_per_second=self.bytes_read / self.hash_time if self.hash_time else 0.0,
+            )
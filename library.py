@@ -0,0 +1,268 @@
+import base64
+import bisect
+import binascii
+import collections
+import json
+import os
+import threading
+
+"""
+
+In-memory index of the music library, for paginated and searchable listing.
+
+Entries are dicts with at least 'name' and 'hash' keys, plus 'size' and 'mtime'
+for sorting. Entries are identified by name (the path relative to the music root),
+as files with identical content share the hash. The index keeps one sorted order
+per sort key, a trigram index for substring search, and a short log of changes so
+clients can fetch deltas.
+
+"""
+
+# supported sort keys; prefix with '-' for descending order
+SORT_KEYS = ('name', 'size', 'mtime')
+
+# number of versions for which deltas are kept
+CHANGELOG_LENGTH = 50
+
+# default and maximum page size
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 500
+
+
+class QueryError(ValueError):
+    """
+    Invalid library query parameters
+    """
+    pass
+
+
+def trigrams(text):
+    """
+    Get set of all three character substrings of a text
+    """
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def encode_cursor(version, sort_key, position):
+    """
+    Encode a pagination cursor
+    """
+    raw = json.dumps([version, sort_key, position]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor, sort_key):
+    """
+    Decode a pagination cursor for a sort key into version and position (the entry of
+    the sort order of the last item seen)
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        version, cursor_sort_key, position = json.loads(raw.decode())
+    except (ValueError, TypeError, binascii.Error):
+        raise QueryError('Invalid cursor')
+
+    # position must be comparable with the entries of the sort order
+    value_types = (str,) if sort_key == 'name' else (int, float)
+    if cursor_sort_key != sort_key or not isinstance(position, list) or len(position) != 3 or \
+            not isinstance(position[0], value_types) or isinstance(position[0], bool) or \
+            not isinstance(position[1], str) or not isinstance(position[2], str):
+        raise QueryError('Invalid cursor for sort key ' + sort_key)
+
+    return version, tuple(position)
+
+
+class LibraryIndex(object):
+    """
+    Searchable, sortable index of music files with change tracking
+    """
+
+    def __init__(self):
+        # library version, incremented on every change
+        self.version = 0
+
+        # random id of this index instance - versions start over after a restart, with
+        # possibly different files, so they are only meaningful together with the epoch
+        self.epoch = binascii.b2a_hex(os.urandom(4)).decode()
+
+        # name -> entry
+        self.entries = dict()
+
+        # sort key -> list of (key value, casefolded name, name), ascending
+        self.orders = dict()
+
+        # casefolded names, ascending, with names - for prefix search
+        self.names = []
+
+        # trigram -> set of names - for substring search
+        self.trigram_index = collections.defaultdict(set)
+
+        # list of (version, added names, removed names)
+        self.changelog = collections.deque(maxlen=CHANGELOG_LENGTH)
+
+        self.lock = threading.Lock()
+
+    def update(self, files):
+        """
+        Replace library content, return True if anything changed
+        """
+        new_entries = {f['name']: f for f in files}
+
+        with self.lock:
+            added = [name for name, f in new_entries.items() if self.entries.get(name) != f]
+            removed = [name for name in self.entries if name not in new_entries]
+            if not added and not removed:
+                return False
+
+            self.entries = new_entries
+            self.rebuild()
+
+            self.version += 1
+            self.changelog.append((self.version, added, removed))
+
+        return True
+
+    def etag(self):
+        """
+        Get an ETag value for responses depending on library content, unique across restarts
+        """
+        return 'lib-%s-%d' % (self.epoch, self.version)
+
+    def rebuild(self):
+        """
+        Rebuild sort orders and search indices - call with lock held
+        """
+        self.orders = dict()
+        self.names = []
+        self.trigram_index = collections.defaultdict(set)
+
+        for file_name in self.entries:
+            name = file_name.casefold()
+            self.names.append((name, file_name))
+            for trigram in trigrams(name):
+                self.trigram_index[trigram].add(file_name)
+
+        self.names.sort()
+
+        for sort_key in SORT_KEYS:
+            if sort_key == 'name':
+                self.orders[sort_key] = [(name, name, file_name) for name, file_name in self.names]
+            else:
+                self.orders[sort_key] = sorted(
+                    (self.entries[file_name].get(sort_key, 0), name, file_name)
+                    for name, file_name in self.names)
+
+    def search(self, text, match):
+        """
+        Get set of names of entries matching a search text - call with lock held
+        """
+        text = text.casefold()
+
+        if match == 'prefix':
+            out = set()
+            i = bisect.bisect_left(self.names, (text, ''))
+            while i < len(self.names) and self.names[i][0].startswith(text):
+                out.add(self.names[i][1])
+                i += 1
+            return out
+
+        if len(text) < 3:
+            return {file_name for name, file_name in self.names if text in name}
+
+        # candidates contain all trigrams of the search text, verify with substring test
+        candidates = None
+        for trigram in trigrams(text):
+            matches = self.trigram_index.get(trigram, set())
+            candidates = matches if candidates is None else candidates & matches
+            if not candidates:
+                return set()
+
+        return {file_name for file_name in candidates if text in file_name.casefold()}
+
+    def query(self, text=None, match='substring', sort='name', cursor=None, limit=DEFAULT_LIMIT):
+        """
+        Get one page of (optionally filtered) library entries
+
+        :param text: search text, None or empty for all entries
+        :param match: 'prefix' or 'substring'
+        :param sort: sort key, optionally prefixed with '-' for descending order
+        :param cursor: cursor returned with the previous page, None for the first page
+        :param limit: maximum number of entries to return
+        :return: dict with version, total number of matches, entries and cursor of next page
+        """
+        descending = sort.startswith('-')
+        sort_key = sort.lstrip('-')
+        if sort_key not in SORT_KEYS:
+            raise QueryError('Unknown sort key: ' + sort)
+        if match not in ('prefix', 'substring'):
+            raise QueryError('Unknown match type: ' + match)
+        limit = max(1, min(limit, MAX_LIMIT))
+
+        with self.lock:
+            order = self.orders.get(sort_key, [])
+
+            # start position: after the last item of the previous page
+            if cursor:
+                _, position = decode_cursor(cursor, sort_key)
+                if descending:
+                    start = bisect.bisect_left(order, position) - 1
+                else:
+                    start = bisect.bisect_right(order, position)
+            else:
+                start = len(order) - 1 if descending else 0
+
+            matches = self.search(text, match) if text else None
+            total = len(order) if matches is None else len(matches)
+
+            # collect one more than requested to find out if there is a next page
+            positions = []
+            step = -1 if descending else 1
+            i = start
+            while 0 <= i < len(order) and len(positions) <= limit:
+                if matches is None or order[i][2] in matches:
+                    positions.append(order[i])
+                i += step
+
+            more = len(positions) > limit
+            positions = positions[:limit]
+
+            return dict(
+                version=self.version,
+                total=total,
+                items=[self.entries[position[2]] for position in positions],
+                cursor=encode_cursor(self.version, sort_key, positions[-1]) if more else None,
+            )
+
+    def changes(self, since, epoch=None):
+        """
+        Get entries added and names removed since a given version
+
+        If the version is too old for the change log or belongs to another epoch (e.g.
+        before a restart), 'reset' is True and the client has to reload the library
+        with query(); no entries are returned then.
+        """
+        with self.lock:
+            if epoch != self.epoch or since > self.version or not self.changelog or \
+                    since < self.changelog[0][0] - 1:
+                return dict(version=self.version, epoch=self.epoch, reset=True, added=[], removed=[])
+
+            if since == self.version:
+                return dict(version=self.version, epoch=self.epoch, reset=False, added=[], removed=[])
+
+            added = set()
+            removed = set()
+            for version, version_added, version_removed in self.changelog:
+                if version <= since:
+                    continue
+                added.update(version_added)
+                added.difference_update(version_removed)
+                removed.update(version_removed)
+                removed.difference_update(version_added)
+
+            return dict(
+                version=self.version,
+                epoch=self.epoch,
+                reset=False,
+                added=[self.entries[name] for name in sorted(added) if name in self.entries],
+                removed=sorted(removed),
+            )
@@ -0,0 +1,145 @@
+import logging
+import os
+import time
+
+import util
+
+"""
+
+Playback positions for resuming music files (e.g. audiobooks) where they were stopped.
+
+Positions are kept in memory and written to an append-only journal in batches, at
+most every flush interval, so the SD card is not written on every polling cycle.
+Each journal line is '<position in seconds>\t<file name>', or '-\t<file name>' for
+a removed position; the last line for a file wins. When the journal has grown to
+several times the number of tracked files, it is compacted by atomically replacing
+it with one line per file.
+
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class PositionJournal(object):
+    """
+    Playback positions by music file name, persisted as a batched journal
+    """
+
+    def __init__(self, file_path, flush_interval=60.0, compact_factor=4):
+        # journal file
+        self.file_path = file_path
+
+        # minimum time between journal writes (seconds)
+        self.flush_interval = flush_interval
+
+        # compact when the journal has more than this many lines per tracked file
+        self.compact_factor = compact_factor
+
+        # file name -> position (seconds)
+        self.positions = dict()
+
+        # changes since last flush: file name -> position, or None if removed
+        self.pending = dict()
+
+        # number of lines in the journal file
+        self.journal_lines = 0
+
+        # last line of the journal was cut off, appending would continue it
+        self.truncated = False
+
+        self.last_flush = time.monotonic()
+
+        self.load()
+
+    def load(self):
+        """
+        Read positions from the journal, if present
+        """
+        try:
+            with open(self.file_path, 'r', encoding='utf-8') as f:
+                lines = f.read().split('\n')
+        except FileNotFoundError:
+            return
+        except (OSError, UnicodeDecodeError) as e:
+            logger.error('Could not load playback positions "%s": %s', self.file_path, e)
+            return
+
+        # the last line is empty, or was cut off by a crash while appending
+        self.truncated = bool(lines[-1])
+        for line in lines[:-1]:
+            self.journal_lines += 1
+            position, _, file_name = line.partition('\t')
+            if not file_name:
+                continue
+            if position == '-':
+                self.positions.pop(file_name, None)
+                continue
+            try:
+                self.positions[file_name] = float(position)
+            except ValueError:
+                continue
+
+    def get(self, file_name):
+        """
+        Get playback position of a music file in seconds, or None
+        """
+        return self.positions.get(file_name)
+
+    def set(self, file_name, position):
+        """
+        Set playback position of a music file in seconds (in memory only, see flush)
+        """
+        if '\n' in file_name:
+            # cannot be stored in the journal
+            return
+        self.positions[file_name] = position
+        self.pending[file_name] = position
+
+    def remove(self, file_name):
+        """
+        Forget playback position of a music file, e.g. when it was played to the end
+        """
+        if self.positions.pop(file_name, None) is not None:
+            self.pending[file_name] = None
+
+    def maybe_flush(self):
+        """
+        Flush pending changes if the flush interval has passed
+        """
+        if self.pending and time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Append pending changes to the journal in one write, compact it if it has grown too long
+        """
+        self.last_flush = time.monotonic()
+        if not self.pending:
+            return
+
+        lines = ''.join('%s\t%s\n' % ('-' if position is None else '%.1f' % position, file_name)
+                        for file_name, position in self.pending.items())
+
+        try:
+            if self.truncated or \
+                    self.journal_lines + len(self.pending) > self.compact_factor * max(len(self.positions), 8):
+                self.compact()
+            else:
+                os.makedirs(os.path.dirname(os.path.abspath(self.file_path)), exist_ok=True)
+                with open(self.file_path, 'a', encoding='utf-8') as f:
+                    f.write(lines)
+                self.journal_lines += len(self.pending)
+        except OSError as e:
+            logger.error('Could not save playback positions "%s": %s', self.file_path, e)
+            return
+
+        self.pending = dict()
+
+    def compact(self):
+        """
+        Replace the journal with one line per tracked file
+        """
+        content = ''.join('%.1f\t%s\n' % (position, file_name) for file_name, position in self.positions.items())
+        util.write_file_atomic(self.file_path, content.encode('utf-8'))
+        self.journal_lines = len(self.positions)
+        self.truncated = False
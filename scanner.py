@@ -0,0 +1,181 @@
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+
+"""
+
+Recursive scanner for the music library.
+
+Directories are listed with os.scandir on a bounded thread pool, so several
+directories are read from the SD card concurrently. Directories whose mtime did
+not change since the last scan are not listed again; their cached file list is
+used instead. Replacing a file in place does not change the mtime of its
+directory, so the files of a cached listing are stat'ed again on every scan.
+
+Files are identified by their path relative to the music root, with '/' as
+separator; see util.safe_join for turning them back into file system paths.
+
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class ScanEntry(object):
+    """
+    Music file found by the scanner
+    """
+
+    __slots__ = ('rel_path', 'path', 'stat')
+
+    def __init__(self, rel_path, path, stat):
+        # path relative to the music root, '/' separated
+        self.rel_path = rel_path
+
+        # file system path
+        self.path = path
+
+        # os.stat_result of the file
+        self.stat = stat
+
+
+class LibraryScanner(object):
+    """
+    Scans a directory tree for music files
+    """
+
+    def __init__(self, root, extensions, max_workers=4):
+        # music root directory
+        self.root = root
+
+        # allowed file extensions, including the dot
+        self.extensions = extensions
+
+        # maximum number of directories listed concurrently
+        self.max_workers = max_workers
+
+        # relative directory path -> (mtime_ns, list of ScanEntry, list of relative subdirectory paths)
+        self.dir_cache = dict()
+
+        # one scan at a time, the web server is threaded
+        self.lock = threading.Lock()
+
+        # statistics of the last scan
+        self.stats = dict(duration=0.0, files=0, files_per_second=0.0, dirs_listed=0, dirs_skipped=0)
+
+    def invalidate(self, rel_dir=None):
+        """
+        Force listing a directory (or all directories, if None) on the next scan
+        """
+        with self.lock:
+            if rel_dir is None:
+                self.dir_cache = dict()
+            else:
+                self.dir_cache.pop(rel_dir, None)
+
+    def list_dir(self, rel_dir, cached):
+        """
+        List one directory, return (rel_dir, mtime_ns, entries, subdirs, listed)
+
+        If the directory mtime matches the cached one, the cached listing is returned.
+        """
+        path = os.path.join(self.root, *rel_dir.split('/')) if rel_dir else self.root
+        mtime_ns = os.stat(path).st_mtime_ns
+
+        if cached is not None and cached[0] == mtime_ns:
+            # same files, but their content may have been overwritten
+            entries = []
+            for entry in cached[1]:
+                try:
+                    entries.append(ScanEntry(entry.rel_path, entry.path, os.stat(entry.path)))
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.warning('Could not scan "%s": %s', entry.path, e)
+            return rel_dir, mtime_ns, entries, cached[2], False
+
+        entries = []
+        subdirs = []
+        with os.scandir(path) as it:
+            for entry in it:
+                # skip hidden files and directories
+                if entry.name.startswith('.'):
+                    continue
+
+                rel_path = rel_dir + '/' + entry.name if rel_dir else entry.name
+
+                # names util.safe_join would refuse later (scandir never returns '/', NUL, '.' or '..')
+                if '\\' in entry.name:
+                    logger.warning('Skipping "%s": backslash in name', entry.path)
+                    continue
+
+                try:
+                    # do not follow symbolic links to directories, to stay inside the music root;
+                    # symbolic links to files are fine (the file system path is not used further)
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(rel_path)
+                    elif entry.is_file() and os.path.splitext(entry.name)[1] in self.extensions:
+                        entries.append(ScanEntry(rel_path, entry.path, entry.stat()))
+                except OSError as e:
+                    logger.warning('Could not scan "%s": %s', entry.path, e)
+
+        return rel_dir, mtime_ns, entries, subdirs, True
+
+    def scan(self):
+        """
+        Scan the music root recursively, return list of ScanEntry sorted by relative path
+        """
+        with self.lock:
+            start = time.perf_counter()
+
+            new_cache = dict()
+            dirs_listed = 0
+            dirs_skipped = 0
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                pending = {executor.submit(self.list_dir, '', self.dir_cache.get(''))}
+
+                while pending:
+                    done, pending = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+
+                    for future in done:
+                        try:
+                            rel_dir, mtime_ns, entries, subdirs, listed = future.result()
+                        except OSError as e:
+                            logger.warning('Could not scan directory: %s', e)
+                            continue
+
+                        new_cache[rel_dir] = (mtime_ns, entries, subdirs)
+                        if listed:
+                            dirs_listed += 1
+                        else:
+                            dirs_skipped += 1
+
+                        for subdir in subdirs:
+                            pending.add(executor.submit(self.list_dir, subdir, self.dir_cache.get(subdir)))
+
+            # directories not seen any more are dropped from the cache
+            self.dir_cache = new_cache
+
+            out = [entry for _, entries, _ in new_cache.values() for entry in entries]
+            out.sort(key=lambda entry: entry.rel_path)
+
+            duration = time.perf_counter() - start
+            self.stats = dict(
+                duration=duration,
+                files=len(out),
+                files_per_second=len(out) / duration if duration > 0 else 0.0,
+                dirs_listed=dirs_listed,
+                dirs_skipped=dirs_skipped,
+            )
+
+        return out
+
+    def get_stats(self):
+        """
+        Get statistics of the last scan
+        """
+        # stats are replaced as a whole, no need to wait for a running scan
+        return dict(self.stats)
@@ -3,9 +3,39 @@ SERVER_SECRET = 'REPLACE_THIS_SECRET'
 MUSIC_ROOT = '/home/pi/Music'
 ALLOWED_EXTENSIONS = {'.mp3', '.ogg'}
 
+# let a front end web server that supports the X-Sendfile header (Apache with mod_xsendfile,
+# lighttpd) send media files; nginx uses X-Accel-Redirect instead and is not supported
+USE_X_SENDFILE = False
+
+# directory for persistent runtime data (fingerprint cache, tag mappings, ...)
+DATA_ROOT = '/home/pi/.nfcmusik'
+
+# content fingerprints: size of sampled blocks (bytes) and number of blocks
+# sampled from the middle of a file, in addition to head and tail
+FINGERPRINT_BLOCK_SIZE = 64 * 1024
+FINGERPRINT_MIDDLE_BLOCKS = 8
+
+# number of directories below MUSIC_ROOT that are scanned concurrently
+SCAN_WORKERS = 4
+
 START_SOUND = None
 DEFAULT_VOLUME = 70
 
+# board pin connected to the IRQ output of the RC522 reader, None if not connected
+# (the reader's status register is polled then)
+RFID_IRQ_PIN = None
+
+# record all SPI transactions with the reader to this file ('{pid}' is replaced by the
+# process id, and appended if missing), None to disable; see spitrace.py
+SPI_TRACE_FILE = None  # e.g. '/home/pi/tmp/nfcmusik-{pid}.spitrace'
+
+# resume music files where they were stopped: positions are written to DATA_ROOT at most
+# every N seconds (and when a token is removed), positions below N seconds are not resumed,
+# resuming goes back N seconds
+RESUME_FLUSH_INTERVAL = 60
+RESUME_MIN_POSITION = 10
+RESUME_REWIND = 3
+
 # shut down wlan0 interface N seconds after startup (or last server interaction)
 WLAN_OFF_DELAY = 180
 
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+
+import atexit
+import os
+import struct
+import sys
+import time
+
+"""
+
+Recording and replay of SPI transactions between RFID.py and the RC522 reader.
+
+Trace file format: 8 byte header (magic, version), followed by records of
+    uint32 time since previous record in microseconds (little endian)
+    uint8 transaction length n
+    n bytes sent, n bytes received
+Records with n = 0 are reads of the driver's clock (for command deadlines), their
+time is the value read. Version 1 traces have no clock records.
+
+Recording: pass an SPIRecorder to RFID(recorder=...). Records are collected in a
+preallocated buffer and appended to the trace file when the buffer is full or
+the flush interval has passed, so recording does not slow down polling.
+
+Replay: RFID(transport=ReplayTransport(path)) feeds recorded responses back to
+the driver, off-device and without timing dependency, e.g. for regression and
+performance tests with traces recorded in the field. The transport also provides
+the driver's clock, returning the recorded clock reads, so commands that ran into
+their deadline are replayed as such.
+
+Summary of a trace: python3 spitrace.py <trace file>
+
+"""
+
+MAGIC = b'NFCSPI\x02\x00'
+
+# traces without clock records
+MAGIC_V1 = b'NFCSPI\x01\x00'
+
+RECORD_HEADER = struct.Struct('<IB')
+
+# complete record of a two byte transaction (register read or write), the common case
+RECORD_2 = struct.Struct('<IBBBBB')
+
+# recorders by process id and file path
+_recorders = dict()
+
+
+class ReplayError(Exception):
+    """
+    Replayed driver deviates from the recorded trace, or the trace is exhausted
+    """
+    pass
+
+
+class SPIRecorder(object):
+    """
+    Logs SPI transactions to a binary trace file
+    """
+
+    def __init__(self, file_path, buffer_size=256 * 1024, flush_interval=10.0):
+        # trace file, records are appended
+        self.file_path = file_path
+
+        # preallocated record buffer and write position
+        self.buffer = bytearray(buffer_size)
+        self.position = 0
+
+        # write buffer to file at least this often
+        self.flush_interval_ns = int(flush_interval * 1e9)
+
+        self.last_time = time.monotonic_ns()
+        self.last_flush = self.last_time
+
+        # number of recorded transactions
+        self.count = 0
+
+        # start a new trace file
+        with open(file_path, 'wb') as f:
+            f.write(MAGIC)
+
+    def record(self, tx, rx):
+        """
+        Record one transaction of sent and received bytes
+        """
+        now = time.monotonic_ns()
+        n = len(tx)
+        size = RECORD_HEADER.size + 2 * n
+
+        if self.position + size > len(self.buffer) or now - self.last_flush > self.flush_interval_ns:
+            self.flush()
+            self.last_flush = now
+
+        # advance by the recorded delta only, so rounding errors do not add up
+        delta = min(max(now - self.last_time, 0) // 1000, 0xFFFFFFFF)
+        self.last_time += delta * 1000
+
+        if n == 2:
+            RECORD_2.pack_into(self.buffer, self.position, delta, 2, tx[0], tx[1], rx[0], rx[1])
+        else:
+            RECORD_HEADER.pack_into(self.buffer, self.position, delta, n)
+            position = self.position + RECORD_HEADER.size
+            self.buffer[position:position + n] = bytes(tx)
+            self.buffer[position + n:position + size - RECORD_HEADER.size] = bytes(rx)
+        self.position += size
+        self.count += 1
+
+    def record_clock(self, t):
+        """
+        Record a clock read of the driver, t is the time.monotonic() value read
+        """
+        now = int(t * 1e9)
+
+        if self.position + RECORD_HEADER.size > len(self.buffer) or now - self.last_flush > self.flush_interval_ns:
+            self.flush()
+            self.last_flush = now
+
+        delta = min(max(now - self.last_time, 0) // 1000, 0xFFFFFFFF)
+        self.last_time += delta * 1000
+
+        RECORD_HEADER.pack_into(self.buffer, self.position, delta, 0)
+        self.position += RECORD_HEADER.size
+
+    def flush(self):
+        """
+        Append buffered records to the trace file
+        """
+        if self.position == 0:
+            return
+        with open(self.file_path, 'ab') as f:
+            f.write(memoryview(self.buffer)[:self.position])
+        self.position = 0
+
+
+def get_recorder(path_template):
+    """
+    Get the recorder of this process for a trace file path containing '{pid}' (the web
+    server and the polling process both talk to the reader); if it does not, the process
+    id is appended, so the processes do not overwrite each other's trace
+    """
+    if '{pid}' not in path_template:
+        path_template += '.{pid}'
+
+    pid = os.getpid()
+    file_path = path_template.format(pid=pid)
+    recorder = _recorders.get((pid, file_path))
+    if recorder is None:
+        recorder = SPIRecorder(file_path)
+        _recorders[(pid, file_path)] = recorder
+        atexit.register(recorder.flush)
+    return recorder
+
+
+def flush_recorders():
+    """
+    Flush recorders of this process - call before a multiprocessing child process exits,
+    atexit handlers do not run there
+    """
+    pid = os.getpid()
+    for (recorder_pid, _), recorder in _recorders.items():
+        if recorder_pid == pid:
+            recorder.flush()
+
+
+def read_trace(file_path):
+    """
+    Read a trace file, yield (time in seconds since start, sent bytes, received bytes);
+    sent and received bytes are empty for clock reads
+    """
+    with open(file_path, 'rb') as f:
+        data = f.read()
+
+    if data[:len(MAGIC)] not in (MAGIC, MAGIC_V1):
+        raise ValueError('Not an SPI trace file: ' + file_path)
+
+    position = len(MAGIC)
+    elapsed = 0
+    while position + RECORD_HEADER.size <= len(data):
+        delta, n = RECORD_HEADER.unpack_from(data, position)
+        position += RECORD_HEADER.size
+        if position + 2 * n > len(data):
+            # truncated last record, e.g. power loss while flushing
+            break
+        elapsed += delta
+        yield elapsed / 1e6, data[position:position + n], data[position + n:position + 2 * n]
+        position += 2 * n
+
+
+class ReplayTransport(object):
+    """
+    Transport for RFID feeding back the responses of a recorded trace
+    """
+
+    def __init__(self, file_path, strict=True):
+        # list of (time in seconds, sent bytes, received bytes)
+        self.records = list(read_trace(file_path))
+        self.position = 0
+
+        # virtual clock: time of the last replayed record
+        self.clock = 0.0
+
+        # check that the driver sends what was recorded
+        self.strict = strict
+
+    def transfer(self, data):
+        # clock reads the driver does not do any more (or in a trace of non-strict use)
+        while not self.strict and self.position < len(self.records) and not self.records[self.position][1]:
+            self.position += 1
+
+        if self.position >= len(self.records):
+            raise ReplayError('Trace exhausted after %d transactions' % self.position)
+
+        t, tx, rx = self.records[self.position]
+        if self.strict and bytes(data) != tx:
+            raise ReplayError('Transaction %d: expected %s, driver sent %s' % (
+                self.position, tx.hex() if tx else 'clock read', bytes(data).hex()))
+
+        self.position += 1
+        self.clock = t
+        return tuple(rx)
+
+    def monotonic(self):
+        """
+        Replay a recorded clock read; without one (version 1 trace), return the time of
+        the last replayed record
+        """
+        if self.position < len(self.records) and not self.records[self.position][1]:
+            self.clock = self.records[self.position][0]
+            self.position += 1
+        return self.clock
+
+    def sleep(self, seconds):
+        # time only passes as recorded
+        pass
+
+    def wait_irq(self, timeout):
+        # responses, not timing, drive the replay
+        return True
+
+    def close(self):
+        pass
+
+    def remaining(self):
+        """
+        Get number of transactions not replayed yet
+        """
+        return len(self.records) - self.position
+
+
+def main(file_path):
+    count = 0
+    duration = 0.0
+    bytes_sent = 0
+    for duration, tx, _ in read_trace(file_path):
+        if tx:
+            count += 1
+            bytes_sent += len(tx)
+
+    print('Transactions: {:d}'.format(count))
+    print('Bytes sent: {:d}'.format(bytes_sent))
+    print('Duration: {:.3f} s'.format(duration))
+    if duration > 0:
+        print('Transactions per second: {:.1f}'.format(count / duration))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
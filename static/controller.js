@@ -1,44 +1,201 @@
-// reload list of music files and render it
+// state of the virtualized music file list - only rows in view are rendered
+var library = {
+    // height of one row in pixels, must match .music-file in custom.css
+    rowHeight: 56,
+    // rows rendered above and below the visible area
+    overscan: 10,
+    // page size when loading entries
+    pageSize: 200,
+    // loaded entries in display order, number of matching entries and cursor of next page
+    items: [],
+    total: 0,
+    cursor: null,
+    // library version on the server, and epoch of the server process it belongs to
+    version: -1,
+    epoch: null,
+    // search text and sort order
+    query: '',
+    sort: 'name',
+    loading: false,
+    // incremented whenever the list is reset, to drop responses of outdated requests
+    generation: 0
+};
+
+// hash of the music file currently previewed in the browser, or null
+var preview = null;
+
+// play preview of a music file in the browser, or stop it if it is playing already
+function togglePreview(hash) {
+    var player = document.getElementById('previewPlayer');
+
+    $('.btn-preview > .glyphicon').removeClass('glyphicon-pause').addClass('glyphicon-play');
+
+    if (preview === hash) {
+        player.pause();
+        preview = null;
+        return;
+    }
+
+    preview = hash;
+    player.src = 'media/' + hash;
+    player.play();
+    $('.music-file[data-hash="' + hash + '"] > .btn-preview > .glyphicon').removeClass('glyphicon-play').addClass('glyphicon-pause');
+}
+
+// refresh list of music files on the server and reload the list if anything changed
 function refreshMusicFiles() {
-    $.getJSON('json/musicfiles', function (data) {
-        var ul = $('<ul/>')
-            .addClass('list-group');
-
-        $.each(data, function (i, f) {
-            var li = $('<li/>')
-                .attr('id', f.hash)
-                .addClass('music-file')
-                .addClass('list-group-item clearfix')
-                .html('<span class="glyphicon glyphicon-music" aria-hidden="true"></span> ' + f.name + '<br>')
-                .appendTo(ul);
+    var params = {since: library.version};
+    if (library.epoch) {
+        params.epoch = library.epoch;
+    }
+    $.getJSON('json/library/changes', params, function (data) {
+        if (data.version !== library.version || data.epoch !== library.epoch || data.reset) {
+            library.version = data.version;
+            library.epoch = data.epoch;
+            resetMusicFiles();
+        }
+    });
+}
 
-            $('<button/>')
-                .attr('type', 'button')
-                .addClass('btn btn-primary')
-                .click(function () {
-                    writeNFC(f.hash);
-                })
-                .html('<span class="glyphicon glyphicon-save" aria-hidden="true"></span> Write')
-                .appendTo(li);
+// drop loaded entries and load the first page for the current search and sort order
+function resetMusicFiles() {
+    library.generation++;
+    library.items = [];
+    library.total = 0;
+    library.cursor = null;
+    library.loading = false;
+    $('#musicFiles').scrollTop(0);
+    loadMusicFiles();
+}
 
-            $('<button/>')
-                .attr('type', 'button')
-                .addClass("btn btn-danger")
-                .click(function () {
-                    deleteFile(f.name, f.hash);
-                })
-                .html('<span class="glyphicon glyphicon-remove" aria-hidden="true"></span> Delete')
-                .appendTo(li);
-        });
+// load next page of music files
+function loadMusicFiles() {
+    if (library.loading || (library.items.length > 0 && !library.cursor)) {
+        return;
+    }
+    library.loading = true;
+
+    var generation = library.generation;
+    var params = {sort: library.sort, limit: library.pageSize};
+    if (library.query) {
+        params.q = library.query;
+    }
+    if (library.cursor) {
+        params.cursor = library.cursor;
+    }
 
-        $('#musicFiles').html(ul);
+    $.getJSON('json/library', params, function (data) {
+        if (generation !== library.generation) {
+            return;
+        }
+        library.loading = false;
+        library.items = library.items.concat(data.items);
+        library.total = data.total;
+        library.cursor = data.cursor;
+        renderMusicFiles();
+    }).fail(function () {
+        if (generation === library.generation) {
+            library.loading = false;
+        }
     });
 }
 
-function writeNFC(data) {
+// create list entry for a music file
+function musicFileRow(f) {
+    // files with identical content share the hash, so it is not unique per row
+    var li = $('<li/>')
+        .attr('data-hash', f.hash)
+        .addClass('music-file')
+        .addClass('list-group-item clearfix');
+
+    // buttons float right, so the first one is rightmost
+    $('<button/>')
+        .attr('type', 'button')
+        .addClass('btn btn-sm btn-primary')
+        .click(function () {
+            writeNFC(f.hash, li);
+        })
+        .html('<span class="glyphicon glyphicon-save" aria-hidden="true"></span> Write')
+        .appendTo(li);
+
+    $('<button/>')
+        .attr('type', 'button')
+        .addClass('btn btn-sm btn-default btn-assign')
+        .attr('title', 'Play this file with the current tag, without writing the tag')
+        .click(function () {
+            assignUID(f.hash, li);
+        })
+        .html('<span class="glyphicon glyphicon-link" aria-hidden="true"></span> Assign')
+        .appendTo(li);
+
+    $('<button/>')
+        .attr('type', 'button')
+        .addClass('btn btn-sm btn-danger')
+        .click(function () {
+            deleteFile(f.name, li);
+        })
+        .html('<span class="glyphicon glyphicon-remove" aria-hidden="true"></span> Delete')
+        .appendTo(li);
+
+    $('<button/>')
+        .attr('type', 'button')
+        .addClass('btn btn-sm btn-default btn-preview')
+        .attr('title', 'Preview')
+        .click(function () {
+            togglePreview(f.hash);
+        })
+        .html('<span class="glyphicon ' + (preview === f.hash ? 'glyphicon-pause' : 'glyphicon-play') +
+            '" aria-hidden="true"></span>')
+        .appendTo(li);
+
+    $('<span/>')
+        .addClass('glyphicon glyphicon-music')
+        .attr('aria-hidden', 'true')
+        .appendTo(li);
+
+    $('<span/>')
+        .addClass('music-file-name')
+        .attr('title', f.name)
+        .text(' ' + f.name)
+        .appendTo(li);
+
+    return li;
+}
+
+// render the rows currently in view, load more entries if needed
+function renderMusicFiles() {
+    var viewport = $('#musicFiles');
+    var spacer = $('#musicFilesSpacer');
+
+    if (library.total === 0 && !library.loading) {
+        spacer.css('height', 'auto').html('<p class="text-muted">No music files found</p>');
+        return;
+    }
+
+    var scrollTop = viewport.scrollTop();
+    var first = Math.max(0, Math.floor(scrollTop / library.rowHeight) - library.overscan);
+    var last = Math.min(library.total,
+        Math.ceil((scrollTop + viewport.height()) / library.rowHeight) + library.overscan);
+
+    if (last > library.items.length) {
+        loadMusicFiles();
+    }
+
+    var ul = $('<ul/>')
+        .addClass('list-group')
+        .css('top', first * library.rowHeight);
+
+    for (var i = first; i < Math.min(last, library.items.length); i++) {
+        musicFileRow(library.items[i]).appendTo(ul);
+    }
+
+    spacer.css('height', library.total * library.rowHeight).html(ul);
+}
+
+function writeNFC(data, row) {
     $.getJSON('actions/writenfc?data=' + data, function (ret) {
-        var icon = $('#' + data + ' > .btn > .glyphicon').first();
-        var btn = $('#' + data + ' > .btn').first();
+        var icon = row.children('.btn').first().children('.glyphicon');
+        var btn = row.children('.btn').first();
 
         if (ret.success) {
             // tag successfully written - give simple feedback to user as the music is about to start playing anyway
@@ -81,17 +238,68 @@ function writeNFC(data) {
     });
 }
 
-function deleteFile(name, data) {
+function assignUID(data, row) {
+    $.getJSON('actions/assignuid?data=' + data, function (ret) {
+        var icon = row.children('.btn-assign').children('.glyphicon');
+        var btn = row.children('.btn-assign');
+
+        if (ret.success) {
+            // tag assigned - give simple feedback to user as the music is about to start playing anyway
+            icon.removeClass('glyphicon-link');
+            icon.addClass('glyphicon-ok');
+            btn.removeClass('btn-default');
+            btn.addClass('btn-success');
+
+            setTimeout(function () {
+                icon.removeClass('glyphicon-ok');
+                icon.addClass('glyphicon-link');
+                btn.removeClass('btn-success');
+                btn.addClass('btn-default');
+            }, 3000);
+
+            console.info(ret.message);
+        } else {
+            $('#modal-text').text(ret.message);
+            $('#modal-dialog').modal('show');
+            console.error(ret.message);
+        }
+    }).fail(function () {
+        var err = 'Request Failed';
+        $('#modal-text').text(err);
+        $('#modal-dialog').modal('show');
+        console.error(err);
+    });
+}
+
+function unassignUID() {
+    $.getJSON('actions/unassignuid', function (ret) {
+        if (ret.success) {
+            console.info(ret.message);
+            pollNFC();
+        } else {
+            $('#modal-text').text(ret.message);
+            $('#modal-dialog').modal('show');
+            console.error(ret.message);
+        }
+    }).fail(function () {
+        var err = 'Request Failed';
+        $('#modal-text').text(err);
+        $('#modal-dialog').modal('show');
+        console.error(err);
+    });
+}
+
+function deleteFile(name, row) {
     if (confirm('Do you really want to delete "' + name + '"?')) {
-        $.getJSON('actions/deletefile?data=' + data, function (ret) {
+        $.getJSON('actions/deletefile', {name: name}, function (ret) {
             if (ret.success) {
                 // the file was successfully deleted - refresh the file list
                 refreshMusicFiles();
                 console.info(ret.message);
             } else {
                 // there was an issue deleting the file - provide status message to user
-                var icon = $('#' + data + ' > .btn > .glyphicon').first();
-                var btn = $('#' + data + ' > .btn').first();
+                var icon = row.children('.btn').first().children('.glyphicon');
+                var btn = row.children('.btn').first();
 
                 icon.removeClass('glyphicon-save');
                 icon.addClass('glyphicon-exclamation-sign');
@@ -121,6 +329,14 @@ function deleteFile(name, data) {
 function pollNFC() {
     $.getJSON('json/readnfc', function (data) {
         $('#nfcStatusBox').html('<span title="UID: ' + data['uid'] + ', data: ' + data['data'] + '">' + data['description'] + '</span>');
+        if (data['assigned']) {
+            $('<button/>')
+                .attr('type', 'button')
+                .addClass('btn btn-sm btn-default pull-right')
+                .click(unassignUID)
+                .html('<span class="glyphicon glyphicon-remove" aria-hidden="true"></span> Unassign')
+                .appendTo('#nfcStatusBox');
+        }
         $('#connectionLost').hide();
     }).fail(function () {
         $('#connectionLost').show();
@@ -147,7 +363,79 @@ function submitUpload() {
     $("#form").submit();
 }
 
+function selectBackupFile() {
+    document.getElementById("backupFile").click();
+}
+
+function restoreBackup() {
+    var input = document.getElementById("backupFile");
+    if (input.files.length === 0) {
+        return;
+    }
+
+    // send the archive as request body, the server reads it as a stream
+    $('#restoreButton').prop('disabled', true);
+    $.ajax({
+        url: 'actions/restore',
+        type: 'POST',
+        data: input.files[0],
+        contentType: 'application/x-tar',
+        processData: false,
+        dataType: 'json'
+    }).done(function (ret) {
+        if (ret.success) {
+            console.info(ret.message);
+        } else {
+            console.error(ret.message);
+        }
+        $('#modal-text').text(ret.message);
+        $('#modal-dialog').modal('show');
+        refreshMusicFiles();
+    }).fail(function (xhr) {
+        var err = (xhr.responseJSON && xhr.responseJSON.message) || 'Request Failed';
+        $('#modal-text').text(err);
+        $('#modal-dialog').modal('show');
+        console.error(err);
+    }).always(function () {
+        $('#restoreButton').prop('disabled', false);
+        input.value = '';
+    });
+}
+
 function initialize() {
+    // reset preview button when preview has finished
+    $('#previewPlayer').on('ended', function () {
+        preview = null;
+        $('.btn-preview > .glyphicon').removeClass('glyphicon-pause').addClass('glyphicon-play');
+    });
+
+    // re-render music file list when scrolling, at most once per frame
+    var renderPending = false;
+    $('#musicFiles').scroll(function () {
+        if (!renderPending) {
+            renderPending = true;
+            window.requestAnimationFrame(function () {
+                renderPending = false;
+                renderMusicFiles();
+            });
+        }
+    });
+
+    // search as you type, but not on every key stroke
+    var searchTimeout = null;
+    $('#librarySearch').on('input', function () {
+        clearTimeout(searchTimeout);
+        searchTimeout = setTimeout(function () {
+            library.query = $('#librarySearch').val();
+            resetMusicFiles();
+        }, 300);
+    });
+
+    $('#librarySort').change(function () {
+        library.sort = $(this).val();
+        resetMusicFiles();
+    });
+
     // fill music file list
     refreshMusicFiles();
 
@@ -0,0 +1,149 @@
+import binascii
+import json
+import logging
+import threading
+
+import settings
+import util
+
+"""
+
+Local mapping from tag UIDs to music file hashes.
+
+Lets a factory-blank tag play a music file without writing the tag: the poll loop
+resolves the UID obtained during anticollision (4 bytes, or 7 bytes over two cascade
+levels as with NTAG213), so no page read is needed. Tags that are not in the store
+fall back to the music file hash written to the tag.
+
+The mapping is kept in memory as a dict indexed by UID and persisted as a JSON
+file, which is replaced atomically on every change.
+
+"""
+
+logger = logging.getLogger(__name__)
+
+# lengths of single and double size UIDs, as returned by RFID.read_uid (bytes)
+UID_LENGTHS = (4, 7)
+
+
+def decode_mapping(tags):
+    """
+    Decode a UID -> music file hash mapping with hex strings, as persisted and in backups
+
+    Entries that could not be played (wrong UID length, data not a 16 byte music file
+    hash) are skipped.
+    """
+    mapping = dict()
+    for uid, data in tags.items():
+        try:
+            uid_bytes, data_bytes = binascii.a2b_hex(uid), binascii.a2b_hex(data)
+        except (TypeError, ValueError):
+            uid_bytes, data_bytes = b'', b''
+
+        if len(uid_bytes) not in UID_LENGTHS or len(data_bytes) != 16 or \
+                data_bytes[:1] != settings.CONTROL_BYTES['MUSIC_FILE']:
+            logger.warning('Skipping invalid tag mapping %r -> %r', uid, data)
+            continue
+
+        mapping[uid_bytes] = data_bytes
+    return mapping
+
+
+class TagStore(object):
+    """
+    UID -> music file hash mapping with crash-safe persistence
+    """
+
+    def __init__(self, file_path):
+        # JSON file holding the mapping
+        self.file_path = file_path
+
+        # UID (bytes) -> music file hash (bytes)
+        self.mapping = dict()
+
+        self.lock = threading.Lock()
+
+        self.load()
+
+    def load(self):
+        """
+        Load mapping from file, if present
+        """
+        try:
+            with open(self.file_path, 'r') as f:
+                content = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error('Could not load tag mappings "%s": %s', self.file_path, e)
+            return
+
+        with self.lock:
+            self.mapping = decode_mapping(content.get('tags', dict()))
+
+    def save(self):
+        """
+        Write mapping to file atomically - call with lock held
+        """
+        content = dict(tags={binascii.b2a_hex(uid).decode(): binascii.b2a_hex(data).decode()
+                             for uid, data in self.mapping.items()})
+        util.write_file_atomic(self.file_path, json.dumps(content, indent=1, sort_keys=True).encode())
+
+    def assign(self, uid, data):
+        """
+        Map a tag UID to music file hash data, persist immediately
+        """
+        with self.lock:
+            previous = self.mapping.get(uid)
+            self.mapping[uid] = data
+            try:
+                self.save()
+            except OSError:
+                # keep memory and disk consistent
+                if previous is None:
+                    del self.mapping[uid]
+                else:
+                    self.mapping[uid] = previous
+                raise
+
+    def update(self, mappings):
+        """
+        Map several tag UIDs to music file hash data, persist once
+        """
+        with self.lock:
+            previous = dict(self.mapping)
+            self.mapping.update(mappings)
+            try:
+                self.save()
+            except OSError:
+                self.mapping = previous
+                raise
+
+    def remove(self, uid):
+        """
+        Remove mapping of a tag UID, return True if there was one
+        """
+        with self.lock:
+            data = self.mapping.pop(uid, None)
+            if data is None:
+                return False
+            try:
+                self.save()
+            except OSError:
+                self.mapping[uid] = data
+                raise
+            return True
+
+    def get(self, uid):
+        """
+        Get music file hash mapped to a tag UID, or None
+        """
+        with self.lock:
+            return self.mapping.get(uid)
+
+    def items(self):
+        """
+        Get a copy of all mappings as list of (UID, music file hash)
+        """
+        with self.lock:
+            return list(self.mapping.items())
@@ -0,0 +1,108 @@
+import io
+import os
+import sys
+import tarfile
+
+import pytest
+
+"""
+
+Backup and restore: round trip through a generated archive, skipping and rejecting files.
+
+"""
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import backup
+import fingerprint
+
+EXTENSIONS = ('.mp3',)
+
+UID = bytes.fromhex('04a23b7c915e80')
+DATA = b'\x11' + bytes(range(15))
+
+
+@pytest.fixture
+def engine():
+    return fingerprint.FingerprintEngine()
+
+
+def make_archive(music_root, engine, names):
+    files = [(name, engine.fingerprint(os.path.join(music_root, name))) for name in names]
+    metadata = backup.make_metadata(files, dict(), [(UID, DATA)])
+    return io.BytesIO(b''.join(backup.generate(music_root, metadata)))
+
+
+def write_file(root, name, content):
+    os.makedirs(os.path.dirname(os.path.join(root, name)), exist_ok=True)
+    with open(os.path.join(root, name), 'wb') as f:
+        f.write(content)
+
+
+def read_file(root, name):
+    with open(os.path.join(root, name), 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture
+def source(tmp_path):
+    root = str(tmp_path / 'source')
+    write_file(root, 'a.mp3', b'a' * 100000)
+    write_file(root, 'sub/b.mp3', b'b' * 513)
+    write_file(root, 'Ünïcode ' + 'x' * 120 + '.mp3', b'c')
+    return root
+
+
+def test_round_trip(tmp_path, source, engine):
+    names = sorted(os.path.relpath(os.path.join(d, f), source) for d, _, fs in os.walk(source) for f in fs)
+    archive = make_archive(source, engine, names)
+
+    target = str(tmp_path / 'target')
+    metadata, counts = backup.restore(archive, target, EXTENSIONS, engine.fingerprint)
+
+    assert counts == dict(restored=3, skipped=0, rejected=0)
+    assert metadata['tags'] == {UID.hex(): DATA.hex()}
+    for name in names:
+        assert read_file(target, name) == read_file(source, name)
+
+    # restoring again: all files present with the same content
+    archive.seek(0)
+    assert backup.restore(archive, target, EXTENSIONS, engine.fingerprint)[1] == \
+        dict(restored=0, skipped=3, rejected=0)
+
+
+def test_restore_skips_present(tmp_path, source, engine):
+    archive = make_archive(source, engine, ['a.mp3', 'sub/b.mp3'])
+
+    # a.mp3 present under another name, sub/b.mp3 present with other content
+    target = str(tmp_path / 'target')
+    write_file(target, 'renamed.mp3', read_file(source, 'a.mp3'))
+    write_file(target, 'sub/b.mp3', b'x' * 513)
+    present = {engine.fingerprint(os.path.join(target, 'renamed.mp3'))}
+
+    counts = backup.restore(archive, target, EXTENSIONS, engine.fingerprint, present)[1]
+
+    assert counts == dict(restored=1, skipped=1, rejected=0)
+    assert not os.path.exists(os.path.join(target, 'a.mp3'))
+    assert read_file(target, 'sub/b.mp3') == read_file(source, 'sub/b.mp3')
+
+
+def test_restore_rejects_members(tmp_path, source, engine):
+    archive = make_archive(source, engine, ['a.mp3'])
+
+    # append members outside of the music directory, of other types and leading outside
+    data = archive.getvalue()[:-2 * tarfile.BLOCKSIZE]
+    for name in ('other.mp3', 'music/notes.txt', 'music/../../escape.mp3'):
+        data += backup.tar_header(name, 1, 0) + b'x' + backup.padding(1)
+    data += bytes(2 * tarfile.BLOCKSIZE)
+
+    target = str(tmp_path / 'target')
+    counts = backup.restore(io.BytesIO(data), target, EXTENSIONS, engine.fingerprint)[1]
+
+    assert counts == dict(restored=1, skipped=0, rejected=3)
+    assert not os.path.exists(os.path.join(str(tmp_path), 'escape.mp3'))
+
+
+def test_restore_invalid_archive(tmp_path):
+    with pytest.raises(backup.BackupError):
+        backup.restore(io.BytesIO(b'no archive' * 100), str(tmp_path), EXTENSIONS, None)
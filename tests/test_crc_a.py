@@ -0,0 +1,57 @@
+import os
+import sys
+
+import pytest
+
+"""
+
+CRC_A (ISO/IEC 14443-3) of the RFID driver: software implementation and the
+coprocessor path (on the simulated reader of benchmarks/fakehw.py) against known
+frames.
+
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import fakehw
+
+# frame, CRC_A as transmitted (LSB first)
+VECTORS = [
+    # ISO/IEC 14443-3 Annex B examples
+    ([0x00, 0x00], [0xA0, 0x1E]),
+    ([0x12, 0x34], [0x26, 0xCF]),
+    # READ page 0, HLTA, RATS
+    ([0x30, 0x00], [0x02, 0xA8]),
+    ([0x50, 0x00], [0x57, 0xCD]),
+    ([0xE0, 0x50], [0xBC, 0xA5]),
+]
+
+
+@pytest.fixture(scope='module')
+def rfid():
+    fakehw.install(fakehw.FakeTag())
+    import RFID
+    return RFID
+
+
+@pytest.mark.parametrize('frame, crc', VECTORS)
+def test_crc_a(rfid, frame, crc):
+    assert rfid.crc_a(frame) == crc
+
+
+@pytest.mark.parametrize('frame, crc', VECTORS)
+def test_calculate_crc(rfid, frame, crc):
+    rdr = rfid.RFID()
+    try:
+        assert rdr.calculate_crc(frame) == crc
+        assert rdr.calculate_crc_hw(frame) == crc
+    finally:
+        rdr.cleanup()
+
+
+def test_crc_a_appended(rfid):
+    # CRC_A over a frame including its CRC is zero
+    for frame, crc in VECTORS:
+        assert rfid.crc_a(frame + crc) == [0x00, 0x00]
@@ -0,0 +1,114 @@
+import os
+import sys
+
+import pytest
+
+"""
+
+LibraryIndex: cursor pagination, search and change tracking.
+
+"""
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import library
+
+
+def make_files(count):
+    return [dict(name='Track %02d.mp3' % i, hash='%032x' % (i % 3), size=(i * 7) % 10, mtime=i)
+            for i in range(count)]
+
+
+def fetch_all(index, sort, limit, text=None):
+    """
+    Follow cursors through all pages, return list of names
+    """
+    names = []
+    cursor = None
+    while True:
+        page = index.query(text=text, sort=sort, cursor=cursor, limit=limit)
+        names.extend(item['name'] for item in page['items'])
+        cursor = page['cursor']
+        if cursor is None:
+            return names
+
+
+@pytest.fixture
+def index():
+    index = library.LibraryIndex()
+    index.update(make_files(25))
+    return index
+
+
+def test_identical_content_kept(index):
+    # several files share a hash, all of them are listed
+    assert index.query(limit=100)['total'] == 25
+
+
+@pytest.mark.parametrize('sort', ['name', '-name', 'size', '-size', 'mtime', '-mtime'])
+@pytest.mark.parametrize('limit', [1, 4, 25, 100])
+def test_pagination(index, sort, limit):
+    files = make_files(25)
+    sort_key = sort.lstrip('-')
+    expected = [f['name'] for f in sorted(
+        files, key=lambda f: (f[sort_key] if sort_key != 'name' else f['name'].casefold(), f['name'].casefold()),
+        reverse=sort.startswith('-'))]
+
+    assert fetch_all(index, sort, limit) == expected
+
+
+def test_search(index):
+    assert fetch_all(index, 'name', 2, text='ck 1') == ['Track %02d.mp3' % i for i in range(10, 20)]
+    assert index.query(text='track 0', match='prefix')['total'] == 10
+    assert index.query(text='xyz')['total'] == 0
+
+
+@pytest.mark.parametrize('cursor', [
+    'not a cursor',
+    library.encode_cursor(1, 'name', [1]),
+    library.encode_cursor(1, 'name', [1, 'a', 'b']),
+    library.encode_cursor(1, 'size', [1, 'a', 'b']),
+])
+def test_invalid_cursor(index, cursor):
+    with pytest.raises(library.QueryError):
+        index.query(sort='name', cursor=cursor)
+
+
+def test_cursor_of_other_sort_key(index):
+    cursor = index.query(sort='size', limit=2)['cursor']
+    with pytest.raises(library.QueryError):
+        index.query(sort='name', cursor=cursor)
+
+
+def test_changes(index):
+    version = index.version
+    epoch = index.epoch
+
+    assert index.changes(version, epoch) == dict(version=version, epoch=epoch, reset=False, added=[], removed=[])
+
+    files = make_files(25)
+    files[0] = dict(files[0], size=99)
+    del files[1]
+    files.append(dict(name='New.mp3', hash='f' * 32, size=1, mtime=1))
+    index.update(files)
+
+    changes = index.changes(version, epoch)
+    assert not changes['reset']
+    assert [f['name'] for f in changes['added']] == ['New.mp3', 'Track 00.mp3']
+    assert changes['removed'] == ['Track 01.mp3']
+
+
+def test_changes_reset(index):
+    version = index.version
+
+    # unknown epoch, e.g. from before a restart
+    changes = index.changes(version, 'other')
+    assert changes['reset'] and changes['added'] == []
+
+    # version too old for the change log
+    for i in range(library.CHANGELOG_LENGTH + 1):
+        index.update(make_files(i))
+    assert index.changes(version, index.epoch)['reset']
+
+    # version from the future
+    assert index.changes(index.version + 1, index.epoch)['reset']
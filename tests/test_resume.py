@@ -0,0 +1,66 @@
+import os
+import sys
+
+import pytest
+
+"""
+
+PositionJournal: loading, truncated journals and compaction.
+
+"""
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import resume
+
+
+@pytest.fixture
+def journal_path(tmp_path):
+    return str(tmp_path / 'positions.journal')
+
+
+def read_lines(file_path):
+    with open(file_path, encoding='utf-8') as f:
+        return f.read().split('\n')
+
+
+def test_flush_load(journal_path):
+    journal = resume.PositionJournal(journal_path)
+    journal.set('a.mp3', 12.34)
+    journal.set('b.mp3', 5.0)
+    journal.remove('b.mp3')
+    journal.set('c.mp3', 7.0)
+
+    # nothing written before flushing
+    assert not os.path.exists(journal_path)
+    journal.flush()
+
+    loaded = resume.PositionJournal(journal_path)
+    assert loaded.positions == {'a.mp3': 12.3, 'c.mp3': 7.0}
+
+
+def test_load_truncated_last_line(journal_path):
+    with open(journal_path, 'w', encoding='utf-8') as f:
+        f.write('10.0\ta.mp3\n-\ta.mp3\n20.0\tb.mp3\n30.0\tb.m')
+
+    journal = resume.PositionJournal(journal_path)
+    assert journal.positions == {'b.mp3': 20.0}
+
+    # the cut off line does not swallow the next change
+    journal.set('c.mp3', 5.0)
+    journal.flush()
+    assert resume.PositionJournal(journal_path).positions == {'b.mp3': 20.0, 'c.mp3': 5.0}
+    assert read_lines(journal_path)[-1] == ''
+
+
+def test_compaction(journal_path):
+    journal = resume.PositionJournal(journal_path, compact_factor=2)
+    for i in range(40):
+        journal.set('a.mp3', float(i))
+        journal.set('b.mp3', float(i))
+        journal.flush()
+        # journal stays bounded by the compaction threshold
+        assert journal.journal_lines <= 2 * 8
+        assert len(read_lines(journal_path)) - 1 == journal.journal_lines
+
+    assert resume.PositionJournal(journal_path).positions == {'a.mp3': 39.0, 'b.mp3': 39.0}
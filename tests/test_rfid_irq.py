@@ -0,0 +1,53 @@
+import os
+import sys
+
+import pytest
+
+"""
+
+IRQ handling of the RFID driver, on the simulated reader of benchmarks/fakehw.py.
+
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import fakehw
+
+PIN_IRQ = 18
+
+
+@pytest.fixture(scope='module')
+def rfid():
+    fakehw.install(fakehw.FakeTag())
+    import RFID
+    return RFID
+
+
+def test_irq_output_enable(rfid):
+    # only interrupts ending the wait (and errors) drive the IRQ output, not TxIRq/LoAlertIRq
+    rdr = rfid.RFID()
+    rdr.request()
+    assert rfid.SPI.chip.registers[0x02] & 0x7F == 0x33
+    rdr.cleanup()
+
+
+def test_wait_irq_asserted(rfid):
+    gpio = rfid.GPIO
+    transport = rfid.HardwareTransport(pin_irq=PIN_IRQ)
+
+    # output active already: no edge to wait for, poll instead
+    gpio.output(PIN_IRQ, 0)
+    assert not transport.wait_irq(0.01)
+
+    gpio.output(PIN_IRQ, 1)
+    assert transport.wait_irq(0.01)
+
+    transport.close()
+
+
+def test_wait_irq_no_pin(rfid):
+    transport = rfid.HardwareTransport()
+    assert not transport.wait_irq(0.01)
+    transport.close()
@@ -0,0 +1,66 @@
+import os
+import sys
+
+import pytest
+
+"""
+
+UID anticollision of the RFID driver, single and double size UIDs, on the simulated
+reader of benchmarks/fakehw.py.
+
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import fakehw
+
+
+@pytest.fixture(scope='module')
+def rfid():
+    fakehw.install(fakehw.FakeTag())
+    import RFID
+    return RFID
+
+
+@pytest.fixture(autouse=True)
+def restore_tag(rfid):
+    tag = rfid.SPI.chip.tag
+    yield
+    rfid.SPI.chip.tag = tag
+
+
+@pytest.mark.parametrize('uid', [
+    (0x04, 0xA2, 0x3B, 0x7C),
+    (0x04, 0xA2, 0x3B, 0x7C, 0x91, 0x5E, 0x80),
+])
+def test_read_uid(rfid, uid):
+    rfid.SPI.chip.tag = fakehw.FakeTag(uid=uid)
+    rdr = rfid.RFID()
+
+    assert not rdr.request()[0]
+    assert rdr.read_uid() == (False, list(uid))
+
+    # tag is still readable afterwards
+    assert not rdr.read(4)[0]
+    rdr.cleanup()
+
+
+def test_read_uid_cascade_level_1(rfid):
+    # cascade level 1 of a double size UID only holds the cascade tag and three UID bytes
+    rfid.SPI.chip.tag = fakehw.FakeTag(uid=(0x04, 0xA2, 0x3B, 0x7C, 0x91, 0x5E, 0x80))
+    rdr = rfid.RFID()
+
+    rdr.request()
+    err, serial_number = rdr.anticoll()
+    assert not err and serial_number[:4] == [0x88, 0x04, 0xA2, 0x3B]
+    rdr.cleanup()
+
+
+def test_read_uid_no_tag(rfid):
+    rfid.SPI.chip.tag = None
+    rdr = rfid.RFID()
+
+    assert rdr.read_uid()[0]
+    rdr.cleanup()
@@ -0,0 +1,55 @@
+import os
+import sys
+
+"""
+
+LibraryScanner: listing, cached directories and file names.
+
+"""
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scanner
+
+
+def names(entries):
+    return [entry.rel_path for entry in entries]
+
+
+def test_scan(tmp_path):
+    (tmp_path / 'album').mkdir()
+    (tmp_path / 'album' / 'b.mp3').write_bytes(b'b')
+    (tmp_path / 'a.ogg').write_bytes(b'a')
+    (tmp_path / '.hidden.mp3').write_bytes(b'h')
+    (tmp_path / 'notes.txt').write_bytes(b'n')
+    (tmp_path / 'back\\slash.mp3').write_bytes(b'x')
+
+    assert names(scanner.LibraryScanner(str(tmp_path), {'.mp3', '.ogg'}).scan()) == ['a.ogg', 'album/b.mp3']
+
+
+def test_symlinks(tmp_path):
+    root = tmp_path / 'music'
+    outside = tmp_path / 'outside'
+    root.mkdir()
+    outside.mkdir()
+    (outside / 'linked.mp3').write_bytes(b'l')
+    os.symlink(str(outside / 'linked.mp3'), str(root / 'linked.mp3'))
+    os.symlink(str(outside), str(root / 'folder'))
+
+    # linked files are listed, linked folders are not followed
+    assert names(scanner.LibraryScanner(str(root), {'.mp3'}).scan()) == ['linked.mp3']
+
+
+def test_overwrite_in_cached_directory(tmp_path):
+    (tmp_path / 'a.mp3').write_bytes(b'1' * 1000)
+    library_scanner = scanner.LibraryScanner(str(tmp_path), {'.mp3'})
+    assert library_scanner.scan()[0].stat.st_size == 1000
+
+    # replacing content does not change the directory mtime
+    mtime_ns = os.stat(str(tmp_path)).st_mtime_ns
+    (tmp_path / 'a.mp3').write_bytes(b'2' * 5000)
+    os.utime(str(tmp_path), ns=(mtime_ns, mtime_ns))
+
+    entries = library_scanner.scan()
+    assert library_scanner.get_stats()['dirs_skipped'] == 1
+    assert entries[0].stat.st_size == 5000
@@ -0,0 +1,41 @@
+import json
+import os
+import sys
+
+"""
+
+TagStore: persistence and validation of loaded mappings.
+
+"""
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tagstore
+
+DATA = b'\x11' + bytes(range(15))
+
+
+def test_save_load(tmp_path):
+    file_path = str(tmp_path / 'tags.json')
+    store = tagstore.TagStore(file_path)
+    store.assign(bytes(4), DATA)
+    store.assign(bytes(7), DATA)
+
+    assert sorted(tagstore.TagStore(file_path).items()) == [(bytes(4), DATA), (bytes(7), DATA)]
+
+
+def test_load_skips_invalid(tmp_path):
+    valid = '04a23b7c'
+    tags = {
+        valid: DATA.hex(),
+        # cascade level 1 UID with BCC
+        '88a23b7c6d': DATA.hex(),
+        '04a23b7c915e': DATA.hex(),
+        '04a23b7d': DATA[:15].hex(),
+        '04a23b7e': (b'\x12' + DATA[1:]).hex(),
+        '04a23b7f': 'not hex',
+    }
+    file_path = tmp_path / 'tags.json'
+    file_path.write_text(json.dumps(dict(tags=tags)))
+
+    assert tagstore.TagStore(str(file_path)).items() == [(bytes.fromhex(valid), DATA)]
@@ -1,4 +1,6 @@
+import os
 import subprocess
+import tempfile
 
 
 def set_volume(percentage):
@@ -13,3 +15,68 @@ def set_volume(percentage):
 
     # set the volume via amixer
     subprocess.call(['amixer', '-M', 'set', '--', 'PCM', str(percentage) + '%'])
+
+
+def write_file_atomic(file_path, data):
+    """
+    Write data to a file so that readers see either the old or the new content,
+    even if the process dies or power is lost while writing
+
+    :param file_path: path of the file to write
+    :param data: content, bytes
+    """
+
+    dir_name = os.path.dirname(os.path.abspath(file_path))
+    os.makedirs(dir_name, exist_ok=True)
+
+    # write to temporary file in the same directory, then rename over the target
+    fd, tmp_path = tempfile.mkstemp(dir=dir_name, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+    # make the rename itself durable
+    try:
+        dir_fd = os.open(dir_name, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def safe_join(root, rel_path):
+    """
+    Turn a '/' separated path relative to root into a file system path, refusing
+    paths that would lead outside of root ('..', absolute paths, directory links)
+
+    :param root: root directory
+    :param rel_path: relative path, e.g. from a library scan or a request
+    :return: file system path
+    """
+
+    parts = rel_path.split('/')
+    if rel_path.startswith('/') or '\\' in rel_path or '\0' in rel_path or \
+            any(part in ('', '.', '..') for part in parts):
+        raise ValueError('Illegal relative path: ' + rel_path)
+
+    path = os.path.join(root, *parts)
+
+    # refuse symbolic links to directories outside of root (the file itself may be a
+    # link, e.g. a music file linked into MUSIC_ROOT)
+    real_root = os.path.realpath(root)
+    if len(parts) > 1 and \
+            os.path.commonpath([real_root, os.path.realpath(os.path.dirname(path))]) != real_root:
+        raise ValueError('Path outside of root: ' + rel_path)
+
+    return path
@@ -1,14 +1,22 @@
 import binascii
-import glob
+import gzip
 import hashlib
 import json
 import logging
 import os
+import time
 
-from flask import Flask, render_template, request, redirect, flash
+from flask import Flask, Response, abort, render_template, request, redirect, flash, send_file
 from werkzeug.utils import secure_filename
 
+import assets
+import backup
+import fingerprint
+import library
+import scanner
 import settings
+import tagstore
+import util
 
 logger = logging.getLogger(__name__)
 app = Flask(__name__)
@@ -16,46 +24,294 @@ app = Flask(__name__)
 # global dictionary of music file hashes and names
 music_files_dict = dict()
 
+# searchable index of music files, its version changes whenever the list of files changes
+library_index = library.LibraryIndex()
+
 # RFID handler instance
 rfid_handler = None
 
+# content fingerprints of music files, and aliases for older name based hashes
+fingerprint_engine = fingerprint.FingerprintEngine(
+    cache_file=os.path.join(settings.DATA_ROOT, 'fingerprints.json'))
+
+# recursive scanner for music files below MUSIC_ROOT
+library_scanner = scanner.LibraryScanner(
+    settings.MUSIC_ROOT, settings.ALLOWED_EXTENSIONS, max_workers=settings.SCAN_WORKERS)
+
+# static files with content hashed URLs and precompressed variants
+static_assets = assets.StaticAssets(
+    app.static_folder, os.path.join(settings.DATA_ROOT, 'static'))
+
+# browser cache lifetime of media files (seconds); URLs contain the content fingerprint
+MEDIA_MAX_AGE = 24 * 3600
+
+# compress JSON responses larger than this (bytes)
+JSON_COMPRESS_MIN_SIZE = 1024
+
+# reset the WLAN shutdown timer at least this often while streaming a backup (seconds)
+BACKUP_KEEPALIVE_INTERVAL = 10
+
+
+def json_response(out, etag=None):
+    """
+    Create JSON response, answering conditional requests with 304 if the ETag matches
+    and compressing larger responses if the client supports it
+    """
+    if etag is not None and request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    body = json.dumps(out).encode()
+    response = Response(body, mimetype='application/json')
+
+    if etag is not None:
+        # client may cache, but must revalidate
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+
+    if len(body) >= JSON_COMPRESS_MIN_SIZE and 'gzip' in request.accept_encodings:
+        response.set_data(gzip.compress(body, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+
+    return response
+
+
+@app.url_defaults
+def static_version(endpoint, values):
+    """
+    Add content hash to URLs of static files, so browsers can cache them forever
+    """
+    if endpoint == 'static' and 'filename' in values:
+        version = static_assets.version(values['filename'])
+        if version:
+            values['v'] = version
+
+
+def static_file(filename):
+    """
+    Serve static file, precompressed if possible
+    """
+    return static_assets.send(filename, request)
+
+
+# replace flask's default static file view
+app.view_functions['static'] = static_file
+
 
 def music_file_hash(file_name):
     """
     Get hash of music file name, replace first byte with a control byte for music playing.
+
+    Superseded by content fingerprints; tags written with name hashes are resolved
+    via the fingerprint alias table.
     """
     m = hashlib.md5()
     m.update(file_name.encode())
     return settings.CONTROL_BYTES['MUSIC_FILE'] + m.digest()[1:]
 
 
+def refresh_music_files():
+    """
+    Refresh internal cache of music files and hashes, return list of music files
+    and file identifier hashes.
+    """
+    global music_files_dict
+
+    out = []
+    new_music_files_dict = dict()
+    for entry in library_scanner.scan():
+        try:
+            file_hash = fingerprint_engine.fingerprint(entry.path, entry.stat)
+        except OSError as e:
+            logger.error('Could not fingerprint music file "%s": %s', entry.rel_path, e)
+            continue
+
+        # keep tags written with the name based hash working, also after renaming
+        fingerprint_engine.add_alias(music_file_hash(entry.rel_path), file_hash)
+
+        out.append(dict(name=entry.rel_path,
+                        hash=binascii.b2a_hex(file_hash).decode(),
+                        size=entry.stat.st_size,
+                        mtime=int(entry.stat.st_mtime)))
+
+        # files with identical content share the fingerprint, tags play the first one
+        if file_hash in new_music_files_dict:
+            logger.info('Music file "%s" has the same content as "%s"',
+                        entry.rel_path, new_music_files_dict[file_hash])
+        else:
+            new_music_files_dict[file_hash] = entry.rel_path
+
+    # resolve aliases of files currently present
+    for alias, file_hash in fingerprint_engine.get_aliases().items():
+        if file_hash in new_music_files_dict and alias not in new_music_files_dict:
+            new_music_files_dict[alias] = new_music_files_dict[file_hash]
+
+    music_files_dict = new_music_files_dict
+
+    library_index.update(out)
+
+    fingerprint_engine.prune()
+    fingerprint_engine.save()
+
+    # set music files dict in RFID handler
+    if rfid_handler:
+        rfid_handler.set_music_files_dict(music_files_dict)
+
+    return out
+
+
 @app.route('/json/musicfiles')
 def music_files():
     """
     Get a list of music files and file identifier hashes as JSON; also refresh
     internal cache of music files and hashes.
     """
-    global music_files_dict
+    out = refresh_music_files()
+    return json_response(out, etag=library_index.etag())
 
-    file_paths = sorted(glob.glob(os.path.join(settings.MUSIC_ROOT, '*')))
 
-    out = []
-    music_files_dict = dict()
-    for file_path in file_paths:
-        file_name = os.path.split(file_path)[1]
+@app.route('/json/library')
+def library_query():
+    """
+    Get one page of music files as JSON, optionally filtered and sorted
 
-        _, file_extension = os.path.splitext(file_name)
-        if file_extension in settings.ALLOWED_EXTENSIONS:
-            file_hash = music_file_hash(file_name)
-            out.append(dict(name=file_name,
-                            hash=binascii.b2a_hex(file_hash).decode()))
-            music_files_dict[file_hash] = file_name
+    Get arguments: 'q' search text, 'match' ('prefix' or 'substring'), 'sort' ('name',
+    'size' or 'mtime', prefixed with '-' for descending order), 'cursor' as returned
+    with the previous page and 'limit' for the page size.
+    """
+    try:
+        out = library_index.query(
+            text=request.args.get('q'),
+            match=request.args.get('match', 'substring'),
+            sort=request.args.get('sort', 'name'),
+            cursor=request.args.get('cursor'),
+            limit=request.args.get('limit', library.DEFAULT_LIMIT, type=int),
+        )
+    except library.QueryError as e:
+        return json.dumps(dict(success=False, message=str(e))), 400
 
-    # set music files dict in RFID handler
+    return json_response(out, etag='lib-%s-%d' % (library_index.epoch, out['version']))
+
+
+@app.route('/json/library/changes')
+def library_changes():
+    """
+    Refresh music files, get files added and removed since the library version given
+    in get argument 'since' (with its 'epoch', as returned by earlier calls) as JSON
+    """
+    refresh_music_files()
+    since = request.args.get('since', -1, type=int)
+    epoch = request.args.get('epoch')
+    return json_response(library_index.changes(since, epoch),
+                         etag='%s-%d-%s' % (library_index.etag(), since, epoch == library_index.epoch))
+
+
+@app.route('/media/<hex_hash>')
+def media(hex_hash):
+    """
+    Serve a music file for preview in the browser, addressed by its hash
+
+    Supports Range requests (seeking) and conditional requests. The file is streamed in
+    blocks (or handed to the server's sendfile, if supported) and never read as a whole.
+    """
+    try:
+        data = binascii.a2b_hex(hex_hash)
+    except (binascii.Error, ValueError):
+        abort(404)
+
+    file_name = music_files_dict.get(data)
+    if file_name is None:
+        abort(404)
+
+    try:
+        file_path = util.safe_join(settings.MUSIC_ROOT, file_name)
+    except ValueError:
+        abort(404)
+
+    if not os.path.isfile(file_path):
+        abort(404)
+
+    response = send_file(file_path, conditional=True, etag=True, max_age=MEDIA_MAX_AGE)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+
+def keep_wlan_on(blocks):
+    """
+    Pass through blocks of a streamed response, keeping WLAN on until the last one is sent
+    """
+    last_reset = 0
+    for block in blocks:
+        if rfid_handler and time.monotonic() - last_reset > BACKUP_KEEPALIVE_INTERVAL:
+            rfid_handler.reset_startup_timer()
+            last_reset = time.monotonic()
+        yield block
+
+
+@app.route('/backup')
+def backup_download():
+    """
+    Download a backup of all music files, fingerprint aliases and tag UID assignments as tar
+    archive, generated while it is sent
+    """
+    files = [(f['name'], binascii.a2b_hex(f['hash'])) for f in refresh_music_files()]
+    metadata = backup.make_metadata(
+        files,
+        fingerprint_engine.get_aliases(),
+        rfid_handler.get_uid_assignments() if rfid_handler else [],
+    )
+
+    response = Response(keep_wlan_on(backup.generate(settings.MUSIC_ROOT, metadata)),
+                        mimetype='application/x-tar')
+    response.headers['Content-Disposition'] = 'attachment; filename="nfcmusik-backup-%s.tar"' % (
+        time.strftime('%Y%m%d-%H%M%S', time.localtime(metadata['created'])))
+    response.cache_control.no_store = True
+    return response
+
+
+@app.route('/actions/restore', methods=['POST'])
+def backup_restore():
+    """
+    Restore a backup archive sent as request body
+
+    Music files already present with the same content are skipped. Fingerprint aliases
+    and tag UID assignments of the backup are added to the current ones.
+    """
     if rfid_handler:
-        rfid_handler.set_music_files_dict(music_files_dict)
+        rfid_handler.reset_startup_timer()
+
+    present = {binascii.a2b_hex(f['hash']) for f in refresh_music_files()}
 
-    return json.dumps(out)
+    try:
+        metadata, counts = backup.restore(request.stream, settings.MUSIC_ROOT, settings.ALLOWED_EXTENSIONS,
+                                          fingerprint_engine.fingerprint, present)
+
+        for alias, file_hash in metadata.get('aliases', dict()).items():
+            fingerprint_engine.add_alias(binascii.a2b_hex(alias), binascii.a2b_hex(file_hash))
+
+        # invalid assignments are skipped, see decode_mapping
+        tags = tagstore.decode_mapping(metadata.get('tags', dict()))
+        tags_rejected = len(metadata.get('tags', dict())) - len(tags)
+        if tags and rfid_handler:
+            rfid_handler.assign_uids(tags)
+    except backup.BackupError as e:
+        return json.dumps(dict(success=False, message=str(e))), 400
+    except (OSError, ValueError) as e:
+        return json.dumps(dict(success=False, message='Could not restore backup: %s' % e))
+    finally:
+        # pick up restored files, also after a partial restore
+        library_scanner.invalidate()
+        refresh_music_files()
+
+    return json.dumps(dict(
+        success=True,
+        message='Restored %d files, %d already present, %d skipped as invalid; '
+                '%d tag assignments, %d skipped as invalid' % (
+                    counts['restored'], counts['skipped'], counts['rejected'], len(tags), tags_rejected)
+    ))
 
 
 @app.route('/json/readnfc')
@@ -90,10 +346,28 @@ def read_nfc():
             else:
                 description = 'Play a music file not currently present on the device'
 
+    # is the tag assigned by UID instead of by written data?
+    assigned = uid is not None and rfid_handler.get_uid_assignment(uid) is not None
+    if assigned:
+        description += ' (assigned by tag UID)'
+
     # output container
-    out = dict(uid=hex_uid, data=hex_data, description=description)
+    out = dict(uid=hex_uid, data=hex_data, assigned=assigned, description=description)
 
-    return json.dumps(out)
+    # description depends on tag state and music library only
+    return json_response(out, etag='nfc-%s-%s-%s-%d' % (library_index.etag(), hex_uid, hex_data, assigned))
+
+
+@app.route('/json/stats')
+def stats():
+    """
+    Get performance statistics
+    """
+    return json.dumps(dict(
+        fingerprint=fingerprint_engine.get_stats(),
+        scanner=library_scanner.get_stats(),
+        rfid_errors=rfid_handler.get_rfid_errors() if rfid_handler else dict(),
+    ))
 
 
 @app.route('/json/wlantimeout')
@@ -150,31 +424,105 @@ def write_nfc():
     ))
 
 
-@app.route('/actions/deletefile')
-def delete_file():
+@app.route('/actions/assignuid')
+def assign_uid():
     """
-    Delete file
+    Assign a music file to the UID of the current NFC tag, without writing the tag
 
     Data is contained in get argument 'data'.
     """
+    if not rfid_handler:
+        return json.dumps(dict(
+            success=False, message='No RFID handler'
+        ))
+
     # acquire data in hex format
     hex_data = request.args.get('data')
     if hex_data is None:
         return json.dumps(dict(
-            success=False, message='No data argument given for deletefile endpoint'
+            success=False, message='No data argument given for assignuid endpoint'
         ))
 
     # convert from hex to bytes
     data = binascii.a2b_hex(hex_data)
 
     if data not in music_files_dict:
-        return json.dumps(dict(success=False, message='Unknown hash value!'))
+        return json.dumps(dict(
+            success=False, message='Unknown hash value!'
+        ))
+
+    uid = rfid_handler.get_uid()
+    if uid is None:
+        return json.dumps(dict(
+            success=False, message='No NFC tag present'
+        ))
+
+    try:
+        rfid_handler.assign_uid(uid, data)
+    except OSError as e:
+        return json.dumps(dict(
+            success=False, message='Could not save tag assignment: %s' % e
+        ))
 
     file_name = music_files_dict[data]
+    return json.dumps(dict(
+        success=True, message='Assigned NFC tag %s to file: %s' % (binascii.b2a_hex(uid).decode(), file_name)
+    ))
+
+
+@app.route('/actions/unassignuid')
+def unassign_uid():
+    """
+    Remove music file assignment of the UID of the current NFC tag
+    """
+    if not rfid_handler:
+        return json.dumps(dict(
+            success=False, message='No RFID handler'
+        ))
+
+    uid = rfid_handler.get_uid()
+    if uid is None:
+        return json.dumps(dict(
+            success=False, message='No NFC tag present'
+        ))
 
     try:
-        os.remove(os.path.join(settings.MUSIC_ROOT, file_name))
+        removed = rfid_handler.unassign_uid(uid)
     except OSError as e:
+        return json.dumps(dict(
+            success=False, message='Could not save tag assignment: %s' % e
+        ))
+
+    if not removed:
+        return json.dumps(dict(
+            success=False, message='NFC tag is not assigned by UID'
+        ))
+
+    return json.dumps(dict(
+        success=True, message='Removed assignment of NFC tag ' + binascii.b2a_hex(uid).decode()
+    ))
+
+
+@app.route('/actions/deletefile')
+def delete_file():
+    """
+    Delete file
+
+    File name relative to MUSIC_ROOT is contained in get argument 'name' (not the hash,
+    files with identical content share it).
+    """
+    file_name = request.args.get('name')
+    if file_name is None:
+        return json.dumps(dict(
+            success=False, message='No name argument given for deletefile endpoint'
+        ))
+
+    if os.path.splitext(file_name)[1] not in settings.ALLOWED_EXTENSIONS:
+        return json.dumps(dict(success=False, message='Not a music file: ' + file_name))
+
+    try:
+        os.remove(util.safe_join(settings.MUSIC_ROOT, file_name))
+    except (OSError, ValueError) as e:
         return json.dumps(dict(success=False, message='Could not delete file: %s' % e))
 
     return json.dumps(dict(success=True, message='The file "%s" was deleted' % file_name))
@@ -194,6 +542,9 @@ def handle_file_upload(files):
     if file_extension in settings.ALLOWED_EXTENSIONS:
         filename = secure_filename(file.filename)
         file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+
+        # an existing file may have been replaced, which does not change the directory mtime
+        library_scanner.invalidate('')
         flash('File "%s" uploaded' % filename, 'success')
     else:
         flash('Invalid file type', 'danger')
@@ -217,9 +568,13 @@ def run_server(rfid_handler_param):
     rfid_handler = rfid_handler_param
 
     # initialize music files dict
-    music_files()
+    refresh_music_files()
+
+    # create compressed variants of static files
+    static_assets.precompress()
 
     app.secret_key = settings.SERVER_SECRET
+    app.config['USE_X_SENDFILE'] = settings.USE_X_SENDFILE
     app.config['UPLOAD_FOLDER'] = settings.MUSIC_ROOT
     app.run(host=settings.SERVER_HOST_MASK, threaded=True)
 